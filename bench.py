@@ -0,0 +1,284 @@
+"""
+Benchmarks of every stage of the pipelines, on reproducible synthetic workloads.
+
+For each stage: ops/sec, latency percentiles (ms) and peak memory (KiB, traced on a sample).
+
+Usage:
+    python bench.py [--scale N] [--seed S] [--only STAGE ...]
+                    [--save baseline.json] [--compare baseline.json] [--output bench_output.txt]
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+from src import columnar, loader, snapshot, vacatio
+from src.cfg import ContextFreeGrammar
+from src.pipeline import Pipeline
+from src.database import Range
+from src.procedure import FilterProcedure, SelectProcedure
+from src.util import Tokenizer
+
+MEMORY_SAMPLE = 50 # operations traced for the peak memory
+THRESHOLD = 0.1 # relative slowdown reported as a regression
+
+def percentile(values, p):
+    k = math.ceil(p / 100 * len(values)) - 1
+    return values[min(max(k, 0), len(values) - 1)]
+
+def measure(func, items):
+    """
+    Run func on every item, returns its throughput, latency percentiles and peak memory
+    """
+    latencies = []
+    clock = time.perf_counter
+    for item in items:
+        start = clock()
+        func(item)
+        latencies.append(clock() - start)
+
+    tracemalloc.start()
+    for item in items[:MEMORY_SAMPLE]:
+        func(item)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    latencies.sort()
+    total = sum(latencies)
+    return {
+        'ops': len(items),
+        'ops_per_sec': len(items) / total if total else float('inf'),
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p90_ms': percentile(latencies, 90) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'peak_kib': peak / 1024,
+    }
+
+# ---------------------------------------------------------------------
+# synthetic workloads
+# ---------------------------------------------------------------------
+
+LOCATIONS = ['Hồ Chí Minh', 'Nha Trang', 'Phú Quốc', 'Đà Nẵng']
+
+def make_questions(rng, n):
+    """
+    The input questions, and longer variants repeating their location phrases
+    """
+    with open('input/questions.txt', 'r', encoding='utf-8') as f:
+        base = f.read().splitlines()
+
+    questions = []
+    for i in range(n):
+        q = base[i % len(base)]
+        if i % 2:
+            k = rng.randint(1, 10)
+            loc = rng.choice(LOCATIONS[1:])
+            q = {
+                1: lambda: f'đi từ Hồ Chí Minh tới {loc} ' * k + 'hết bao lâu?',
+                3: lambda: 'có bao nhiêu tour đi Phú Quốc ' + f'đi {loc} ' * k + 'vậy bạn?',
+            }.get(i % 6, lambda: q)()
+        questions.append(q)
+    return questions
+
+def make_token_map(n):
+    token_map = dict(vacatio.TOKEN_MAP)
+    for i in range(n):
+        token_map[f'địa điểm số {i}'] = f'địa_điểm_số_{i}'
+    return token_map
+
+def make_grammar(n):
+    """
+    context_free_grammar() with n more nouns, verbs and adjectives
+    """
+    base = vacatio.context_free_grammar()
+    rules = {lhs: [list(rhs) for rhs in rhslist] for lhs, rhslist in base.rules.items()}
+    for lhs in ['N', 'V', 'ADJ']:
+        rules[lhs] += [[f'{lhs.lower()}{i}'] for i in range(n)]
+    return ContextFreeGrammar(base.start, rules)
+
+def make_facts(rng, n):
+    """
+    Text of a fact database with n tours
+    """
+    lines = []
+    for i in range(n):
+        tour = f'T{i}'
+        lines.append(f'(TOUR {tour} Tour_{i})')
+        for _ in range(rng.randint(1, 4)):
+            day = f'{rng.randint(1, 28)}/{rng.randint(1, 12)}'
+            lines.append(
+                f'(DTIME {tour} HCMC "{rng.randint(1, 11)}AM {day}") '
+                f'(ATIME {tour} {tour} "{rng.randint(1, 11)}PM {day}")'
+            )
+        lines.append(f'(RUN-TIME {tour} HCM {tour} {rng.randint(1, 12)}:00 HR)')
+        lines.append(f'(BY {tour} {rng.choice(["airplane", "train", "bus"])})')
+    return '\n'.join(lines) + '\n'
+
+def make_procedures(rng, n_tours, n):
+    procs = []
+    for i in range(n):
+        tour = f'T{rng.randrange(n_tours)}'
+        kind = i % 4
+        if kind == 0:
+            procs.append(FilterProcedure('TIME', [tour, None, None, None, None]))
+        elif kind == 1:
+            procs.append(SelectProcedure(4, 'RUN-TIME', [tour, None, None, None]))
+        elif kind == 2:
+            procs.append(SelectProcedure(2, 'BY', [tour, None]))
+        else:
+            procs.append(
+                SelectProcedure((3, 5), 'TIME', [None, 'HCMC', None, None, None])
+                .join(FilterProcedure('BY', [None, 'airplane']))
+                .join(FilterProcedure('TOUR', [tour, None]))
+            )
+    return procs
+
+def make_range_procedures(rng, n):
+    """
+    Tours leaving from HCMC in a time window, optionally within a maximal run time
+    """
+    procs = []
+    for i in range(n):
+        month = rng.randint(1, 12)
+        low = f'{rng.randint(1, 11)}AM {rng.randint(1, 14)}/{month}'
+        high = f'{rng.randint(1, 11)}PM {rng.randint(15, 28)}/{month}'
+        proc = FilterProcedure('TIME', [None, 'HCMC', Range(low, high), None, None])
+        if i % 2:
+            proc.join(FilterProcedure('RUN-TIME', [None, None, None, Range(None, '3:00 HR')]))
+        procs.append(proc)
+    return procs
+
+# ---------------------------------------------------------------------
+# stages
+# ---------------------------------------------------------------------
+
+def run(scale=1, seed=0, only=None):
+
+    rng = random.Random(seed)
+    results = {}
+
+    def stage(name, func, items):
+        if only and name not in only:
+            return
+        with contextlib.redirect_stdout(io.StringIO()):
+            results[name] = measure(func, items)
+
+    questions = make_questions(rng, 600 * scale)
+
+    # dependency pipeline
+    grammar = vacatio.dependency_grammar()
+    tokenizer = Tokenizer(make_token_map(10000 * scale))
+    stage('tokenize', tokenizer.tokenize, questions)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        parses = [grammar.analyze(q) for q in questions]
+        relations = [vacatio.relationalize(p.deps) for p in parses]
+        logical_forms = [vacatio.logicalize(r) for r in relations]
+        procedures = [vacatio.proceduralize(lf) for lf in logical_forms]
+
+    stage('dep_parse', grammar.analyze, questions)
+    stage('relationalize', vacatio.relationalize, [p.deps for p in parses])
+    stage('logicalize', vacatio.logicalize, relations)
+    stage('proceduralize', vacatio.proceduralize, logical_forms)
+
+    # fact database
+    n_tours = 2000 * scale
+    facts = make_facts(rng, n_tours)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'database.txt')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(facts)
+
+        stage('db_load', loader.load, [path] * 3)
+        snapshot.load_cached(path, path + '.snap')
+        stage('db_snapshot_open', lambda p: snapshot.load_cached(p, p + '.snap'), [path] * 10)
+        database = snapshot.SnapshotDatabase(path + '.snap')
+        in_memory = loader.load(path)
+
+        queries = make_procedures(rng, n_tours, 400 * scale)
+        stage('execute', lambda proc: proc.execute(in_memory), queries)
+        stage('execute_snapshot', lambda proc: proc.execute(database), queries)
+        ranges = make_range_procedures(rng, 400 * scale)
+        stage('execute_range', lambda proc: proc.execute(in_memory), ranges)
+
+        # optional numpy backend
+        if columnar.np is not None:
+            vectorized = columnar.ColumnarDatabase.of(in_memory)
+            stage('execute_numpy', lambda proc: proc.execute(vectorized), queries)
+            stage('execute_range_numpy', lambda proc: proc.execute(vectorized), ranges)
+
+        sample_db = loader.load('input/database.txt')
+        stage('answer', lambda proc: vacatio.answer(proc, sample_db), procedures)
+        stage('pipeline_cold', Pipeline(grammar, sample_db, maxsize=0).run, questions)
+        stage('pipeline_warm', Pipeline(grammar, sample_db).run, questions)
+
+        database.close()
+
+    # context-free grammar
+    cfg = make_grammar(1000 * scale)
+    sentences = list(cfg.iter_sample(12, seed=seed, max_samples=200 * scale))
+    stage('cfg_parse', lambda s: cfg._parse_earley(s.split()), sentences)
+
+    samples = cfg.iter_generate(10, seed=seed)
+    stage('cfg_generate', lambda _: next(samples), range(2000 * scale))
+    uniform = cfg.iter_sample(10, seed=seed)
+    stage('cfg_sample', lambda _: next(uniform), range(2000 * scale))
+
+    return results
+
+def report(results, baseline=None):
+
+    lines = [
+        '{0:<20} {1:>8} {2:>12} {3:>9} {4:>9} {5:>9} {6:>10} {7:>10}'.format(
+            'stage', 'ops', 'ops/sec', 'p50 ms', 'p90 ms', 'p99 ms', 'peak KiB', 'vs base'
+        )
+    ]
+    for name, r in results.items():
+        compare = ''
+        if baseline and name in baseline:
+            ratio = r['ops_per_sec'] / baseline[name]['ops_per_sec']
+            compare = f'{ratio:.2f}x' + (' REGRESSION' if ratio < 1 - THRESHOLD else '')
+        lines.append(
+            '{0:<20} {1:>8} {2:>12.1f} {3:>9.3f} {4:>9.3f} {5:>9.3f} {6:>10.1f} {7:>10}'.format(
+                name, r['ops'], r['ops_per_sec'], r['p50_ms'], r['p90_ms'], r['p99_ms'],
+                r['peak_kib'], compare
+            )
+        )
+    return '\n'.join(lines) + '\n'
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline stages')
+    parser.add_argument('--scale', type=int, default=1, help='multiplier of the workload sizes')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--only', nargs='*', help='stages to run')
+    parser.add_argument('--save', help='save the results as a baseline (JSON)')
+    parser.add_argument('--compare', help='baseline (JSON) to compare with')
+    parser.add_argument('--output', help='also write the report to this file')
+    args = parser.parse_args()
+
+    results = run(args.scale, args.seed, args.only)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    text = report(results, baseline)
+    print(text, end='')
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
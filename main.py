@@ -1,5 +1,6 @@
-import re
-from src import vacatio
+from src import snapshot, vacatio
+from src.procedure import ProcedureCache
+from src.util import OutputWriter
 
 # GRAMMAR_FILE = 'output/grammar.txt'
 # SAMPLE_FILE = 'output/samples.txt'
@@ -23,56 +24,35 @@ questions = []
 with open(QUESTION_FILE, 'r', encoding='utf-8') as f:
     questions = f.read().splitlines()
 
-db = {'TOUR': [], 'TIME': [], 'RUN-TIME': [], 'BY': []}
-with open(DATABASE_FILE, 'r', encoding='utf-8') as f:
-    content = f.read()
-    tour_pattern = re.compile(r'\(TOUR (\w+) (\w+)\)')
-    time_pattern = re.compile(r'\(DTIME (\w+) (\w+) "([^"]+)"\) \(ATIME \w+ (\w+) "([^"]+)"\)')
-    runtime_pattern = re.compile(r'\(RUN-TIME (\w+) (\w+) (\w+) ([\d:]+ \w+)\)')
-    by_pattern = re.compile(r'\(BY (\w+) (\w+)\)')
-
-    db['TOUR'] = tour_pattern.findall(content)
-    db['TIME'] = time_pattern.findall(content)
-    db['RUN-TIME'] = runtime_pattern.findall(content)
-    db['BY'] = by_pattern.findall(content)
+db = snapshot.load_cached(DATABASE_FILE)
+cache = ProcedureCache()
 
 grammar = vacatio.dependency_grammar()
 grammar.save()
 dep_lists = grammar.parse_all(questions, save=True)
 
-with open(RELATION_FILE, 'w', encoding='utf-8') as f:
-    f.write('')
-
-with open(LOGICAL_FILE, 'w', encoding='utf-8') as f:
-    f.write('')
-
-with open(ANSWER_FILE, 'w', encoding='utf-8') as f:
-    f.write('')
+with OutputWriter(RELATION_FILE) as rel_out, \
+     OutputWriter(LOGICAL_FILE) as lf_out, \
+     OutputWriter(ANSWER_FILE) as ans_out:
 
-for i, deps in enumerate(dep_lists):
-
-    with open(RELATION_FILE, 'a', encoding='utf-8') as f:
+    for i, deps in enumerate(dep_lists):
 
         relations = vacatio.relationalize(deps)
-        f.write('-----------------------------------\n')
-        f.write(f'Relationalizing: {questions[i]}\n')
-        f.write('-----------------------------------\n')
-        f.write(f'{relations}\n\n')
+        rel_out.write('-----------------------------------\n')
+        rel_out.write(f'Relationalizing: {questions[i]}\n')
+        rel_out.write('-----------------------------------\n')
+        rel_out.write(f'{relations}\n\n')
 
-    with open(LOGICAL_FILE, 'a', encoding='utf-8') as f:
-    
         lf = vacatio.logicalize(relations)
         proc = vacatio.proceduralize(lf)
-        f.write('-----------------------------------\n')
-        f.write(f'Logicalizing and Proceduralizing: {questions[i]}\n')
-        f.write('-----------------------------------\n')
-        f.write(f'{lf}\n')
-        f.write(f'{proc}\n\n')
-
-    with open(ANSWER_FILE, 'a', encoding='utf-8') as f:
-            
-        answer = vacatio.answer(proc, db)
-        f.write('-----------------------------------\n')
-        f.write(f'Answering: {questions[i]}\n')
-        f.write('-----------------------------------\n')
-        f.write(f'{answer}\n\n')
+        lf_out.write('-----------------------------------\n')
+        lf_out.write(f'Logicalizing and Proceduralizing: {questions[i]}\n')
+        lf_out.write('-----------------------------------\n')
+        lf_out.write(f'{lf}\n')
+        lf_out.write(f'{proc}\n\n')
+
+        answer = vacatio.answer(proc, db, cache)
+        ans_out.write('-----------------------------------\n')
+        ans_out.write(f'Answering: {questions[i]}\n')
+        ans_out.write('-----------------------------------\n')
+        ans_out.write(f'{answer}\n\n')
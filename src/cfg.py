@@ -1,4 +1,8 @@
 import random
+from bisect import bisect_right
+from collections import deque
+from itertools import accumulate
+from src.util import OutputWriter
 
 class ContextFreeGrammar:
     """
@@ -10,6 +14,16 @@ class ContextFreeGrammar:
         self.start = start
         self.rules = rules
         self.non_terminals = set(rules.keys())
+        self.nullable = self._nullable()
+
+        # precomputed indexes, used to prune expansions that cannot match the next word
+        # - first: non-terminal -> set of words that can start it
+        # - lexicon: word -> pre-terminals producing it, with their alternative (e.g. "xe" -> {"N": 3}),
+        #   pre-terminals being the non-terminals whose alternatives are all one word
+        # - predictions: non-terminal -> word -> alternatives that can start with the word
+        self.first = self._first()
+        self.preterminals, self.lexicon = self._lexicon()
+        self.predictions, self.nullable_alts = self._predictions()
 
 
     def __str__(self) -> str:
@@ -44,66 +58,317 @@ class ContextFreeGrammar:
 
     def is_terminal(self, symbol):
         return symbol not in self.non_terminals
+
+    def _nullable(self):
+        """
+        Non-terminals that can derive the empty string
+        """
+        nullable = set()
+        changed = True
+        while changed:
+            changed = False
+            for lhs, rhslist in self.rules.items():
+                if lhs not in nullable and any(
+                    all(sym in nullable for sym in rhs) for rhs in rhslist
+                ):
+                    nullable.add(lhs)
+                    changed = True
+        return nullable
+
+    def first_of(self, seq, first=None):
+        """
+        Set of words that can start a sequence of symbols
+        """
+        first = self.first if first is None else first
+        words = set()
+        for sym in seq:
+            if self.is_terminal(sym):
+                words.add(sym)
+                break
+            words |= first[sym]
+            if sym not in self.nullable:
+                break
+        return words
+
+    def _first(self):
+        """
+        FIRST sets of the non-terminals
+        """
+        first = {lhs: set() for lhs in self.rules}
+        changed = True
+        while changed:
+            changed = False
+            for lhs, rhslist in self.rules.items():
+                for rhs in rhslist:
+                    words = self.first_of(rhs, first)
+                    if not words <= first[lhs]:
+                        first[lhs] |= words
+                        changed = True
+        return first
+
+    def _lexicon(self):
+        """
+        Pre-terminals, and the reverse index from words to the pre-terminals producing them
+        """
+        preterminals = {
+            lhs for lhs, rhslist in self.rules.items()
+            if rhslist and all(len(rhs) == 1 and self.is_terminal(rhs[0]) for rhs in rhslist)
+        }
+        lexicon = {}
+        for lhs in preterminals:
+            for alt, (word,) in enumerate(self.rules[lhs]):
+                lexicon.setdefault(word, {}).setdefault(lhs, alt)
+        return preterminals, lexicon
+
+    def _predictions(self):
+        """
+        For each non-terminal, index its alternatives by the words they can start with.
+        Nullable alternatives can match any word, so they go to every entry.
+        """
+        predictions = {}
+        nullable_alts = {}
+        for lhs, rhslist in self.rules.items():
+            index = {}
+            nulls = []
+            for alt, rhs in enumerate(rhslist):
+                if all(sym in self.nullable for sym in rhs):
+                    nulls.append(alt)
+                    for alts in index.values():
+                        alts.append(alt)
+                for word in self.first_of(rhs):
+                    alts = index.setdefault(word, list(nulls))
+                    if not alts or alts[-1] != alt:
+                        alts.append(alt)
+            predictions[lhs] = index
+            nullable_alts[lhs] = nulls
+        return predictions, nullable_alts
+
+    def expansions(self, sym, word):
+        """
+        Alternatives (indexes) of a non-terminal that can derive a string starting with word
+        """
+        return self.predictions[sym].get(word, self.nullable_alts[sym])
     
 
-    def generate(self, max_length=10, max_samples=100, filename = 'output/samples.txt'):
+    def generate(self, max_length=10, max_samples=100, filename = 'output/samples.txt', seed=None):
         """
         Generate sentences from the grammar
         """
-        # sentences = []
-        count = 0
-        with open(filename, 'w', encoding='utf-8') as f:
-            f.write('')
-
-        # perform DFS on tree
-        # node: (list of non-terminals, current sentence)
-        # e.g. ([V NP], ["bạn"])
-        stack = [([self.start], [])] # start with [S], []
+        with OutputWriter(filename, 'w') as writer:
+            for sent in self.iter_generate(max_length, seed=seed, max_samples=max_samples):
+                writer.write(sent + '\n')
 
-        while stack:
+    def iter_generate(self, max_length=10, seed=None, max_samples=None, unique=False, max_seen=1 << 20):
+        """
+        Lazily generate sentences from the grammar, by a randomized DFS on the derivation tree
 
-            seq, sent = stack.pop(random.randint(0, len(stack) - 1)) 
+        - seed: seed of a random generator of its own, for reproducible samples
+          (None: the module-level random, seeded by random.seed)
+        - max_samples: stop after this many sentences (None: until the search is exhausted)
+        - unique: skip duplicated sentences, remembering at most max_seen recent ones
+        """
+        rng = random if seed is None else random.Random(seed)
+        seen = set()
+        history = deque()
+        count = 0
 
-            if not seq:
-                with open(filename, 'a', encoding='utf-8') as f:
-                    f.write(' '.join(sent) + '\n')
+        # symbol sequences as linked lists (sym, rest), so that expanding a
+        # non-terminal or consuming a terminal never copies the whole sequence
+        expansions = {
+            lhs: [self._link(rhs) for rhs in rhslist]
+            for lhs, rhslist in self.rules.items()
+        }
+
+        # node: (symbols left to derive, generated words in reverse, number of words)
+        # e.g. ((V, (NP, None)), ("bạn", None), 1)
+        frontier = [((self.start, None), None, 0)]
+
+        while frontier:
+
+            # pop a random node in O(1), by swapping it with the last one
+            i = rng.randrange(len(frontier))
+            frontier[i], frontier[-1] = frontier[-1], frontier[i]
+            seq, sent, length = frontier.pop()
+
+            if seq is None:
+                words = []
+                while sent is not None:
+                    word, sent = sent
+                    words.append(word)
+                sentence = ' '.join(reversed(words))
+
+                if unique:
+                    key = hash(sentence)
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                    history.append(key)
+                    if len(history) > max_seen:
+                        seen.discard(history.popleft())
+
+                yield sentence
                 count += 1
-                if count >= max_samples:
-                    break
+                if max_samples is not None and count >= max_samples:
+                    return
                 continue
 
-            if len(sent) > max_length:
+            if length > max_length:
                 continue
 
-            sym = seq[0]
+            sym, rest = seq
 
             if self.is_terminal(sym):
-                stack.append((seq[1:], sent + [sym]))
+                # nodes too long to ever be completed are dropped right away
+                if rest is None or length < max_length:
+                    frontier.append((rest, (sym, sent), length + 1))
                 continue
 
-            for rhs in self.rules[sym]:
-                child = (rhs + seq[1:], sent)
-                stack.append(child)
+            for link in expansions[sym]:
+                frontier.append((link(rest), sent, length))
+
+    @staticmethod
+    def _link(rhs):
+        """
+        Function prepending the symbols of rhs to a linked symbol sequence
+        """
+        def link(rest):
+            for sym in reversed(rhs):
+                rest = (sym, rest)
+            return rest
+        return link
+
+    def derivation_counts(self, max_length=10):
+        """
+        Table of the numbers of derivations of each non-terminal by length, see DerivationCounter
+        """
+        return DerivationCounter(self, max_length)
 
-    def parse(self, sentence, filename = 'output/parse-results.txt'):
+    def count(self, max_length=10):
         """
-        Parse a sentence using the grammar with a simple top-down parser
+        Number of derivations of sentences with at most max_length words
         """
+        return self.derivation_counts(max_length).total()
+
+    def iter_sample(self, max_length=10, seed=None, max_samples=None, distinct=False):
+        """
+        Sample sentences with at most max_length words, uniformly among all derivations
+        (seed: as for iter_generate)
+
+        - distinct: sample uniformly among distinct sentences instead, by rejecting
+          ambiguous sentences with probability 1 - 1 / (number of parse trees)
+        """
+        rng = random if seed is None else random.Random(seed)
+        counter = self.derivation_counts(max_length)
+        if not counter.total():
+            return
+
+        count = 0
+        while max_samples is None or count < max_samples:
+            words = counter.sample(rng)
+            if distinct and rng.randrange(self.count_parses(words)):
+                continue
+            yield ' '.join(words)
+            count += 1
+
+    def estimate_distinct(self, max_length=10, samples=10000, seed=None):
+        """
+        Estimate the number of distinct sentences with at most max_length words:
+        (number of derivations) * mean of 1 / (number of parse trees) over uniform derivations
+        """
+        rng = random if seed is None else random.Random(seed)
+        counter = self.derivation_counts(max_length)
+        total = counter.total()
+        if not total:
+            return 0
+        inverse = sum(1 / self.count_parses(counter.sample(rng)) for _ in range(samples))
+        return total * inverse / samples
+
+    def count_parses(self, words):
+        """
+        Number of parse trees of a sentence (list of words)
+        """
+        n = len(words)
+        tree_memo = {}
+        seq_memo = {}
+
+        def trees(sym, i, j):
+            if self.is_terminal(sym):
+                return 1 if j == i + 1 and words[i] == sym else 0
+            if i == j and sym not in self.nullable:
+                return 0
+
+            key = (sym, i, j)
+            if key in tree_memo:
+                if tree_memo[key] is None:
+                    raise ValueError(f'Infinitely many parse trees for {sym} (cyclic rules)')
+                return tree_memo[key]
+            tree_memo[key] = None
+
+            rhslist = self.rules[sym]
+            total = sum(
+                seq(rhslist[alt], 0, i, j)
+                for alt in (self.expansions(sym, words[i]) if i < n else self.nullable_alts[sym])
+            )
+            tree_memo[key] = total
+            return total
+
+        def seq(rhs, pos, i, j):
+            # number of derivations of rhs[pos:] for words[i:j]
+            if pos == len(rhs):
+                return 1 if i == j else 0
+
+            key = (id(rhs), pos, i, j)
+            if key not in seq_memo:
+                total = 0
+                for k in range(j, i - 1, -1):
+                    if k == i and rhs[pos] not in self.nullable:
+                        continue
+                    rest = seq(rhs, pos + 1, k, j)
+                    if rest:
+                        total += trees(rhs[pos], i, k) * rest
+                seq_memo[key] = total
+            return seq_memo[key]
+
+        return trees(self.start, 0, n)
+
+    def parse(self, sentence, filename = 'output/parse-results.txt', engine = 'earley', writer = None):
+        """
+        Parse a sentence using the grammar
+
+        - engine: 'earley' (chart parser, polynomial time) or 'topdown' (simple backtracking parser)
+        - writer: an open OutputWriter to write the result to, instead of appending to filename
+        """
+
+        if writer is None:
+            with OutputWriter(filename, 'a') as writer:
+                return self.parse(sentence, filename, engine, writer)
         
-        with open(filename, 'a', encoding='utf-8') as f:
-            f.write('-----------------------------------\n')
-            f.write(f"Parsing: {sentence}\n")
-        stack = [([self.start], 0, [])]
+        writer.write('-----------------------------------\n')
+        writer.write(f"Parsing: {sentence}\n")
         words = sentence.split()
 
+        if engine == 'earley':
+            tree = self._parse_earley(words)
+        elif engine == 'topdown':
+            tree = self._parse_topdown(words)
+        else:
+            raise ValueError(f'Invalid parser engine: {engine}')
+
+        self._dump_parse_tree(tree, writer)
+
+    def _parse_topdown(self, words):
+        """
+        Simple top-down parser, returns the rules of the first parse tree found
+        """
+        stack = [([self.start], 0, [])]
+
         while stack:
 
             seq, i, tree = stack.pop()
 
             if i == len(words):
                 if not seq:
-                    self._dump_parse_tree(tree, filename)
-                    return
+                    return tree
                 continue
 
             if not seq:
@@ -116,50 +381,350 @@ class ContextFreeGrammar:
                     stack.append((seq[1:], i + 1, tree))
                 continue
 
-            for rhs in self.rules[sym]:
+            rhslist = self.rules[sym]
+            for alt in self.expansions(sym, words[i]):
+                rhs = rhslist[alt]
                 new_tree = tree + [(sym, rhs)]
                 stack.append((rhs + seq[1:], i, new_tree))
 
             # print(stack)
 
-        self._dump_parse_tree(None, filename)
+        return None
 
-    def parse_all(self, sentences, filename = 'output/parse-results.txt'):
+    def _parse_earley(self, words):
         """
-        Parse a list of sentences
+        Earley chart parser, returns the rules of a parse tree (or None)
+
+        The chart is built in O(n^3), then the tree is read back from it, picking
+        the same tree as the top-down parser would on an ambiguous sentence.
+        """
+        n = len(words)
+        nullable = self.nullable
+
+        # item: (lhs, alternative index, dot, origin)
+        chart = [[] for _ in range(n + 1)]
+        seen = [set() for _ in range(n + 1)]
+        # waiting[i][sym]: items in chart[i] with the dot right before sym
+        waiting = [dict() for _ in range(n + 1)]
+        # spans[(sym, i)]: end positions of complete sym starting at i
+        spans = {}
+
+        def add(i, item):
+            if item not in seen[i]:
+                seen[i].add(item)
+                chart[i].append(item)
+
+        for alt in range(len(self.rules[self.start])):
+            add(0, (self.start, alt, 0, 0))
+
+        for i in range(n + 1):
+
+            items = chart[i]
+            k = 0
+
+            while k < len(items):
+
+                lhs, alt, dot, origin = items[k]
+                k += 1
+                rhs = self.rules[lhs][alt]
+
+                # complete
+                if dot == len(rhs):
+                    ends = spans.setdefault((lhs, origin), set())
+                    if i in ends:
+                        continue
+                    ends.add(i)
+                    for wlhs, walt, wdot, worigin in waiting[origin].get(lhs, []):
+                        add(i, (wlhs, walt, wdot + 1, worigin))
+                    continue
+
+                sym = rhs[dot]
+
+                # scan
+                if self.is_terminal(sym):
+                    if i < n and words[i] == sym:
+                        add(i + 1, (lhs, alt, dot + 1, origin))
+                    continue
+
+                # predict
+                wlist = waiting[i].setdefault(sym, [])
+                wlist.append((lhs, alt, dot, origin))
+                if len(wlist) == 1:
+                    if sym in self.preterminals:
+                        # predicted, scanned and completed at once, by the lexicon
+                        salt = self.lexicon.get(words[i], {}).get(sym) if i < n else None
+                        if salt is not None:
+                            add(i + 1, (sym, salt, 1, i))
+                    else:
+                        for salt in (
+                            self.expansions(sym, words[i]) if i < n
+                            else self.nullable_alts[sym]
+                        ):
+                            add(i, (sym, salt, 0, i))
+                if sym in nullable or i in spans.get((sym, i), ()):
+                    add(i, (lhs, alt, dot + 1, origin))
+
+        if n not in spans.get((self.start, 0), ()):
+            return None
+
+        return self._read_tree(words, spans)
+
+    def _read_tree(self, words, spans):
         """
-        with open(filename, 'w', encoding='utf-8') as f:
-            f.write('')
+        Read a parse tree back from the chart spans.
 
-        for sent in sentences:
-            self.parse(sent, filename)
-    
-    def _dump_parse_tree(self, rules, filename):
+        The top-down parser tries the alternatives of a symbol from last to first
+        and returns the first tree found, so the same order is used here.
+        """
+        n = len(words)
+        seq_memo = {}
+        tree_memo = {}
+        active = {} # symbols being read: (sym, i, ends) -> depth
+        NO_CUT = float('inf')
+
+        def sym_ends(sym, i):
+            if self.is_terminal(sym):
+                return (i + 1,) if i < n and words[i] == sym else ()
+            return spans.get((sym, i), ())
+
+        def seq_ends(rhs, pos, i):
+            # end positions of rhs[pos:] derived from position i
+            key = (id(rhs), pos, i)
+            if key not in seq_memo:
+                if pos == len(rhs):
+                    seq_memo[key] = {i}
+                else:
+                    seq_memo[key] = set().union(*[
+                        seq_ends(rhs, pos + 1, j)
+                        for j in sym_ends(rhs[pos], i)
+                    ])
+            return seq_memo[key]
+
+        def best(sym, i, ends):
+            # first tree (rules, end) of sym starting at i and ending in ends, and the
+            # depth of the shallowest active symbol the search was cut off at (cycle guard).
+            # A result depending on a cut above its own symbol is not memoized.
+            if self.is_terminal(sym):
+                return (([], i + 1) if i + 1 in ends and sym_ends(sym, i) else None), NO_CUT
+
+            key = (sym, i, ends)
+            if key in tree_memo:
+                return tree_memo[key], NO_CUT
+            if key in active: # cyclic rules
+                return None, active[key]
+            depth = active[key] = len(active)
+
+            result = None
+            cut = NO_CUT
+            rhslist = self.rules[sym]
+            alts = self.expansions(sym, words[i]) if i < n else self.nullable_alts[sym]
+            for alt in reversed(alts):
+                rhs = rhslist[alt]
+                if not seq_ends(rhs, 0, i) & ends:
+                    continue
+                found, c = derive(rhs, 0, i, ends)
+                cut = min(cut, c)
+                if found is not None:
+                    result = ([(sym, rhs)] + found[0], found[1])
+                    break
+
+            del active[key]
+            if cut >= depth:
+                tree_memo[key] = result
+                cut = NO_CUT
+            return result, cut
+
+        def derive(rhs, pos, j, ends):
+            # first derivation (rules, end) of rhs[pos:] from j ending in ends: the end of
+            # each child is the one of its first tree, or the next one if the rest fails
+            if pos == len(rhs):
+                return (([], j) if j in ends else None), NO_CUT
+
+            child = rhs[pos]
+            child_ends = frozenset(
+                k for k in sym_ends(child, j)
+                if seq_ends(rhs, pos + 1, k) & ends
+            )
+            cut = NO_CUT
+            while child_ends:
+                sub, c = best(child, j, child_ends)
+                cut = min(cut, c)
+                if sub is None:
+                    break
+                rest, c = derive(rhs, pos + 1, sub[1], ends)
+                cut = min(cut, c)
+                if rest is not None:
+                    return (sub[0] + rest[0], rest[1]), cut
+                child_ends = child_ends - {sub[1]}
+            return None, cut
+
+        result, _ = best(self.start, 0, frozenset([n]))
+        return result[0] if result else None
 
-        with open(filename, 'a', encoding='utf-8') as f:
+    def parse_all(self, sentences, filename = 'output/parse-results.txt', engine = 'earley'):
+        """
+        Parse a list of sentences
+        """
+        with OutputWriter(filename, 'w') as writer:
+            for sent in sentences:
+                self.parse(sent, engine=engine, writer=writer)
+    
+    def _dump_parse_tree(self, rules, writer):
             
-            if not rules:
-                f.write("Failed to parse the sentence!\n")
-                return
+        if not rules:
+            writer.write("Failed to parse the sentence!\n")
+            return
 
-            dmap = dict()
-            dmap[rules[0][0]] = 0
-            TAB = "\t"
+        dmap = dict()
+        dmap[rules[0][0]] = 0
+        TAB = "\t"
 
-            for lhs, rhs in rules:
+        for lhs, rhs in rules:
 
-                d = dmap[lhs]
+            d = dmap[lhs]
 
-                if self.is_terminal(rhs[0]):
-                    for _ in range(d): f.write(TAB)
-                    f.write(f"{lhs} {' '.join(rhs)}\n")
+            if self.is_terminal(rhs[0]):
+                writer.write(TAB * d)
+                writer.write(f"{lhs} {' '.join(rhs)}\n")
+
+            else:
+                for sym in rhs: dmap[sym] = d + 1 # gotta fail if CFG is recursive
+                writer.write(TAB * d)
+                writer.write(lhs)
+                writer.write("\n")
 
-                else:
-                    for sym in rhs: dmap[sym] = d + 1 # gotta fail if CFG is recursive
-                    for _ in range(d): f.write(TAB)
-                    f.write("")
-                    f.write(lhs)
-                    f.write("\n")
 
+class DerivationCounter:
+    """
+    Numbers of derivations of each non-terminal by length (number of words),
+    computed with dynamic programming, and a uniform sampler of derivations.
 
+    The counts are derivation (parse tree) counts: they are the numbers of distinct
+    sentences only if the grammar is unambiguous.
+    """
 
+    def __init__(self, grammar, max_length):
+        
+        self.grammar = grammar
+        self.max_length = max_length
+
+        # counts[sym][n]: number of derivations of sym with n words
+        self.counts = {sym: [0] * (max_length + 1) for sym in grammar.rules}
+        # suffixes[sym, alt][pos][n]: number of derivations of rhs[pos:] with n words
+        self.suffixes = {
+            (sym, alt): [[0] * (max_length + 1) for _ in rhs] + [[1] + [0] * max_length]
+            for sym, rhslist in grammar.rules.items()
+            for alt, rhs in enumerate(rhslist)
+        }
+        self.cumulative = {}
+
+        order = self._order()
+
+        for n in range(max_length + 1):
+            for sym in order:
+                self.counts[sym][n] = self._fill(sym, n)
+            # suffixes past the first symbol may refer to symbols counted later
+            # in the same length, recompute them now that all counts are known
+            for sym in order:
+                self._fill(sym, n)
+
+    def _fill(self, sym, n):
+        """
+        Compute the suffix counts of the alternatives of sym for length n, returns their total
+        """
+        total = 0
+        for alt, rhs in enumerate(self.grammar.rules[sym]):
+            suffix = self.suffixes[sym, alt]
+            for pos in range(len(rhs) - 1, -1, -1):
+                suffix[pos][n] = sum(
+                    self.count(rhs[pos], k) * suffix[pos + 1][n - k]
+                    for k in range(n + 1)
+                )
+            total += suffix[0][n]
+        return total
+
+    def _order(self):
+        """
+        Non-terminals sorted so that those a symbol can derive without consuming
+        any word (e.g. A -> B) come before it
+        """
+        grammar = self.grammar
+        deps = {sym: set() for sym in grammar.rules}
+        for sym, rhslist in grammar.rules.items():
+            for rhs in rhslist:
+                for pos, child in enumerate(rhs):
+                    if not grammar.is_terminal(child) and all(
+                        other in grammar.nullable
+                        for other in rhs[:pos] + rhs[pos + 1:]
+                    ):
+                        deps[sym].add(child)
+
+        order = []
+        state = {}
+
+        def visit(sym):
+            if state.get(sym) == 'done':
+                return
+            if state.get(sym) == 'active':
+                raise ValueError(f'Infinitely many derivations for {sym} (cyclic rules)')
+            state[sym] = 'active'
+            for child in deps[sym]:
+                visit(child)
+            state[sym] = 'done'
+            order.append(sym)
+
+        for sym in grammar.rules:
+            visit(sym)
+        return order
+
+    def count(self, sym, n):
+        if self.grammar.is_terminal(sym):
+            return 1 if n == 1 else 0
+        return self.counts[sym][n]
+
+    def total(self, sym=None):
+        """
+        Number of derivations of sym (default: start symbol) with at most max_length words
+        """
+        return sum(self.counts[sym or self.grammar.start])
+
+    def sample(self, rng=random):
+        """
+        Sample a derivation uniformly, returns its words
+        """
+        start = self.grammar.start
+        lengths = list(accumulate(self.counts[start]))
+        n = bisect_right(lengths, rng.randrange(lengths[-1]))
+
+        words = []
+        self._derive(start, n, rng, words)
+        return words
+
+    def _derive(self, sym, n, rng, words):
+
+        if self.grammar.is_terminal(sym):
+            words.append(sym)
+            return
+
+        key = (sym, n)
+        if key not in self.cumulative:
+            self.cumulative[key] = list(accumulate(
+                self.suffixes[sym, alt][0][n]
+                for alt in range(len(self.grammar.rules[sym]))
+            ))
+        cumulative = self.cumulative[key]
+        alt = bisect_right(cumulative, rng.randrange(cumulative[-1]))
+
+        rhs = self.grammar.rules[sym][alt]
+        suffix = self.suffixes[sym, alt]
+
+        for pos, child in enumerate(rhs):
+            # number of words derived by the child, weighted by the derivations left
+            r = rng.randrange(suffix[pos][n])
+            for k in range(n + 1):
+                weight = self.count(child, k) * suffix[pos + 1][n - k]
+                if r < weight:
+                    break
+                r -= weight
+            self._derive(child, k, rng, words)
+            n -= k
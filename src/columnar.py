@@ -0,0 +1,169 @@
+"""
+Optional NumPy backend of the Database: each column is dictionary-encoded (sorted distinct
+values, and the code of each record's value), and criteria are evaluated as vectorized
+boolean masks over the codes. Matched records are decoded with fancy indexing.
+The records are not kept as Python tuples: the relations decode them from the columns.
+The masks of the last criteria are cached, e.g. between the estimate and the match of a
+procedure.
+
+Requires numpy (pip install numpy); procedures run on it unchanged:
+
+    db = ColumnarDatabase.of(loader.load('input/database.txt'))
+    proc.execute(db)
+"""
+
+from src import temporal
+from src.database import Database, Range
+from src.util import LRUCache
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+class CodedRelation:
+    """
+    Read-only sequence of records decoded from dictionary-encoded columns
+    """
+
+    __slots__ = ('columns', 'rows')
+
+    def __init__(self, columns, rows):
+        self.columns = columns
+        self.rows = rows
+
+    def __len__(self):
+        return self.rows
+
+    def __getitem__(self, rid):
+        if isinstance(rid, slice):
+            return [self[i] for i in range(*rid.indices(self.rows))]
+        if rid < 0:
+            rid += self.rows
+        if not 0 <= rid < self.rows:
+            raise IndexError('record index out of range')
+        return tuple(dictionary[codes[rid]] for codes, dictionary, _ in self.columns)
+
+    def __iter__(self):
+        if not self.columns:
+            return iter([()] * self.rows)
+        return zip(*[dictionary[codes].tolist() for codes, dictionary, _ in self.columns])
+
+class ColumnarDatabase(Database):
+
+    def __init__(self, relations=None, types=temporal.COLUMNS):
+        if np is None:
+            raise ImportError('ColumnarDatabase requires numpy (pip install numpy)')
+
+        # relation -> one (codes, dictionary, value -> code) triple per column
+        self.columns = {}
+        self.masks = LRUCache(maxsize=64) # (version, relation, criteria) -> mask
+        super().__init__(relations, types)
+
+    @classmethod
+    def of(cls, database):
+        """
+        Columnar copy of a database (e.g. loaded from a file or a snapshot)
+        """
+        return cls({name: database[name] for name in database.keys()}, database.types)
+
+    def add(self, name, records):
+        super().add(name, records)
+
+        records = self.relations[name]
+        arity = len(records[0]) if len(records) else 0
+        columns = []
+        for column in range(arity):
+            values = np.empty(len(records), dtype=object)
+            values[:] = [rec[column] for rec in records]
+            dictionary, codes = np.unique(values, return_inverse=True)
+            columns.append((
+                codes.astype(np.int32),
+                dictionary,
+                {value: code for code, value in enumerate(dictionary.tolist())},
+            ))
+        self.columns[name] = columns
+        # the records are decoded from the columns, the lists are dropped
+        self.relations[name] = CodedRelation(columns, len(records))
+
+    def mask(self, name, criteria):
+        """
+        Boolean mask of the records matching the criteria, None if there is no bound column
+        """
+        bound = self.bound(name, criteria)
+        if not bound:
+            return None
+
+        key = (self.version, name, tuple(criteria))
+        mask = self.masks.get(key)
+        if mask is None:
+            mask = self._mask(name, bound)
+            mask.flags.writeable = False # shared by the callers
+            self.masks.put(key, mask)
+        return mask
+
+    def _mask(self, name, bound):
+        columns = self.columns[name]
+        mask = np.ones(len(self.relations[name]), dtype=bool)
+
+        for column, value in bound:
+            codes, dictionary, lookup = columns[column]
+
+            if not isinstance(value, Range):
+                code = lookup.get(value)
+                if code is None:
+                    return np.zeros_like(mask)
+                mask &= codes == code
+                continue
+
+            low, high = self.bounds(name, column, value)
+            typed = self.values.get((name, column))
+            if typed is not None:
+                # integer values of a typed column
+                typed = np.frombuffer(typed, dtype=np.int64)
+                mask &= typed != temporal.MISSING
+                if low is not None:
+                    mask &= typed >= low
+                if high is not None:
+                    mask &= typed <= high
+            else:
+                # the dictionary is sorted: a range of values is a range of codes
+                if low is not None:
+                    mask &= codes >= np.searchsorted(dictionary, low, 'left')
+                if high is not None:
+                    mask &= codes < np.searchsorted(dictionary, high, 'right')
+
+        return mask
+
+    def lookup(self, name, criteria):
+        mask = self.mask(name, criteria)
+        if mask is None:
+            return range(len(self.relations[name]))
+        return np.flatnonzero(mask).tolist()
+
+    def match(self, name, criteria):
+        mask = self.mask(name, criteria)
+        if mask is None:
+            return list(self.relations[name])
+
+        ids = np.flatnonzero(mask)
+        return list(zip(*[
+            dictionary[codes[ids]].tolist()
+            for codes, dictionary, _ in self.columns[name]
+        ]))
+
+    def probe(self, name, criteria, column, keys):
+        """
+        Ids of the records matching the criteria whose value in column is one of keys
+        """
+        mask = self.mask(name, criteria)
+        codes, _, lookup = self.columns[name][column]
+        wanted = [lookup[key] for key in keys if key in lookup]
+        keyed = np.isin(codes, wanted)
+        return np.flatnonzero(keyed if mask is None else mask & keyed).tolist()
+
+    def estimate(self, name, criteria):
+        mask = self.mask(name, criteria)
+        if mask is None:
+            return len(self.relations[name])
+        return int(np.count_nonzero(mask))
@@ -0,0 +1,229 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from src import temporal
+
+class Range(namedtuple('Range', ['low', 'high'])):
+    """
+    Criteria value matching the values between low and high (inclusive, None: unbounded).
+    On a typed column, the bounds can be given as text (e.g. "7AM 1/7") or as integers.
+    """
+
+    __slots__ = ()
+
+    def __str__(self):
+        low, high = ['' if bound is None else bound for bound in self]
+        return f'{low}..{high}'
+
+class Database:
+    """
+    In-memory fact database: a list of records (tuples) for each relation,
+    e.g. TOUR | TIME | RUN-TIME | BY, with a hash index on each column.
+
+    The index of a column is built the first time it is probed, and kept until
+    the relation is replaced.
+
+    The typed columns (times and durations, see temporal.COLUMNS) are also parsed
+    to integers when a relation is added, and get a sorted index for Range criteria.
+    A value that cannot be parsed is kept as text in its record, but is never matched
+    by a Range (temporal.MISSING).
+    """
+
+    def __init__(self, relations=None, types=temporal.COLUMNS):
+        self.relations = {}
+        self.indexes = {} # (relation, column) -> value -> ids of the records
+        self.types = types # (relation, column) -> parser of the values
+        self.values = {} # (relation, column) -> integer values of a typed column
+        self.ranges = {} # (relation, column) -> (sorted values, ids of the records in that order)
+        self.version = 0 # incremented on every change, to invalidate cached results
+        for name, records in (relations or {}).items():
+            self.add(name, records)
+
+    def __getitem__(self, name):
+        return self.relations[name]
+
+    def __contains__(self, name):
+        return name in self.relations
+
+    def keys(self):
+        return self.relations.keys()
+
+    def add(self, name, records):
+        self.relations[name] = list(records)
+        self.version += 1
+        for cache in [self.indexes, self.values, self.ranges]:
+            for key in [key for key in cache if key[0] == name]:
+                del cache[key]
+
+        for (relation, column), parse in self.types.items():
+            if relation == name:
+                # each distinct value is parsed once
+                records = self.relations[name]
+                parsed = {
+                    value: temporal.parse_or_missing(parse, value)
+                    for value in {rec[column] for rec in records}
+                }
+                self.values[name, column] = array('q', [parsed[rec[column]] for rec in records])
+
+    def index(self, name, column):
+        """
+        Hash index of a column: value -> ids of the records with that value
+        """
+        key = (name, column)
+        if key not in self.indexes:
+            index = {}
+            for rid, rec in enumerate(self.relations[name]):
+                index.setdefault(rec[column], []).append(rid)
+            self.indexes[key] = index
+        return self.indexes[key]
+
+    def range_index(self, name, column):
+        """
+        Sorted index of a typed column: its values in order, and the ids of their records
+        """
+        key = (name, column)
+        if key not in self.ranges:
+            values = self.values[key]
+            ids = sorted(
+                (rid for rid in range(len(values)) if values[rid] != temporal.MISSING),
+                key=values.__getitem__
+            )
+            self.ranges[key] = ([values[rid] for rid in ids], ids)
+        return self.ranges[key]
+
+    def bounds(self, name, column, value):
+        """
+        Bounds of a Range on a column, parsed if the column is typed
+        """
+        if (name, column) not in self.values:
+            return value
+        parse = self.types[name, column]
+        return tuple(
+            parse(bound) if isinstance(bound, str) else bound
+            for bound in value
+        )
+
+    def bound(self, name, criteria):
+        """
+        (column, value) pairs of the criteria that are bound (not None)
+        """
+        records = self.relations[name]
+        arity = len(records[0]) if len(records) else 0
+        return [
+            (column, value)
+            for column, value in enumerate(criteria[:arity])
+            if value is not None
+        ]
+
+    def _span(self, name, column, value):
+        """
+        Positions in the sorted index of the values of a Range (typed column only)
+        """
+        values, _ = self.range_index(name, column)
+        low, high = self.bounds(name, column, value)
+        return (
+            0 if low is None else bisect_left(values, low),
+            len(values) if high is None else bisect_right(values, high),
+        )
+
+    def _candidates(self, name, column, value):
+        if not isinstance(value, Range):
+            return self.index(name, column).get(value, ())
+        if (name, column) not in self.values:
+            return range(len(self.relations[name]))
+        start, stop = self._span(name, column, value)
+        return self.range_index(name, column)[1][start:stop]
+
+    def _size(self, name, column, value):
+        """
+        Number of candidates of a column, without building them
+        """
+        if not isinstance(value, Range):
+            return len(self.index(name, column).get(value, ()))
+        if (name, column) not in self.values:
+            return len(self.relations[name])
+        start, stop = self._span(name, column, value)
+        return max(0, stop - start)
+
+    def estimate(self, name, criteria):
+        """
+        Upper bound of the number of records matching the criteria
+        """
+        bound = self.bound(name, criteria)
+        if not bound:
+            return len(self.relations[name])
+        return min(self._size(name, column, value) for column, value in bound)
+
+    def lookup(self, name, criteria):
+        """
+        Ids of the records of a relation matching the criteria (one value per column, None for any value).
+        The index of the most selective bound column is probed (a hash index, or the sorted index
+        for a Range), the other columns are checked on the candidates. Without any bound column,
+        this is a full scan. The ids are in database order.
+        """
+        records = self.relations[name]
+        bound = self.bound(name, criteria)
+        if not bound:
+            return range(len(records))
+
+        # only the candidates of the most selective column are built
+        column, value = min(bound, key=lambda item: self._size(name, *item))
+        candidates = self._candidates(name, column, value)
+
+        equal = [(column, value) for column, value in bound if not isinstance(value, Range)]
+        if len(equal) == len(bound):
+            return [
+                rid for rid in candidates
+                if all(records[rid][column] == value for column, value in equal)
+            ]
+
+        # Range criteria: checked on the integer values of typed columns
+        ranges = [
+            (column, self.values.get((name, column)), *self.bounds(name, column, value))
+            for column, value in bound if isinstance(value, Range)
+        ]
+        ids = [
+            rid for rid in candidates
+            if all(records[rid][column] == value for column, value in equal)
+            and all(
+                x != temporal.MISSING and (low is None or low <= x) and (high is None or x <= high)
+                for column, values, low, high in ranges
+                for x in [records[rid][column] if values is None else values[rid]]
+            )
+        ]
+        ids.sort()
+        return ids
+
+    def probe(self, name, criteria, column, keys):
+        """
+        Ids of the records matching the criteria whose value in column is one of keys,
+        looked up key by key. The ids are in database order.
+        """
+        criteria = list(criteria) + [None] * (column + 1 - len(criteria))
+        value = criteria[column]
+        if isinstance(value, Range):
+            # a range on the key column: the keys outside of it are dropped
+            parse = self.types.get((name, column))
+            low, high = self.bounds(name, column, value)
+            criteria[column] = None
+            keys = [
+                key for key in keys
+                for x in [temporal.parse_or_missing(parse, key) if parse and isinstance(key, str) else key]
+                if x != temporal.MISSING and (low is None or low <= x) and (high is None or x <= high)
+            ]
+
+        ids = []
+        for key in keys:
+            keyed = list(criteria)
+            if keyed[column] not in [None, key]:
+                continue
+            keyed[column] = key
+            ids.extend(self.lookup(name, keyed))
+        return sorted(ids)
+
+    def match(self, name, criteria):
+        """
+        Records of a relation matching the criteria, see lookup
+        """
+        records = self.relations[name]
+        return [records[rid] for rid in self.lookup(name, criteria)]
@@ -1,9 +1,53 @@
+from concurrent.futures import ProcessPoolExecutor
+from src import instrument
+from src.util import OutputWriter, Vocabulary
+
+# symbols of the parser, coded as integers (new ones are added when first seen)
+POS = Vocabulary([
+    'ROOT', 'V', 'N', 'N-LOC', 'N-Q', 'PRO', 'PRO-Q', 'AUX',
+    'DET', 'DET-Q', 'P', 'ADV', 'DISC', 'PUNCT', 'UNK',
+])
+LABELS = Vocabulary([
+    'root', 'aux', 'nsubj', 'acl', 'obj', 'obl', 'det', 'case',
+    'csubj', 'advmod', 'discourse', 'punct', 'compound',
+])
+TRANSITIONS = Vocabulary(['SHIFT', 'LEFT_ARC', 'RIGHT_ARC', 'REDUCE'])
+
+SHIFT, LEFT_ARC, RIGHT_ARC, REDUCE = range(4)
+VERB = POS.V
+CASE = LABELS.case
+
+# a transition is coded as one integer: its type in the low bits, its label above
+KIND = 3 # mask of the type bits
+
+def encode_transition(transition):
+    """
+    Code of a transition, e.g. 'LEFT_ARC nsubj'
+    """
+    kind, *label = transition.split()
+    if kind not in TRANSITIONS or len(label) != (kind in ['LEFT_ARC', 'RIGHT_ARC']):
+        raise ValueError(f'Invalid transition: {transition}')
+    return TRANSITIONS[kind] | (LABELS.code(label[0]) << 2 if label else 0)
+
+def decode_transition(code):
+    kind = code & KIND
+    if kind in [LEFT_ARC, RIGHT_ARC]:
+        return f'{TRANSITIONS.name(kind)} {LABELS.name(code >> 2)}'
+    return TRANSITIONS.name(kind)
+
 class Item:
 
+    __slots__ = ('index', 'word', 'pos', 'pos_id')
+
     def __init__(self, index, word, pos):
         self.index = index
         self.word = word
         self.pos = pos
+        self.pos_id = POS.code(pos)
+
+    def __reduce__(self):
+        # codes are per process: pickled by name
+        return Item, (self.index, self.word, self.pos)
 
     def __str__(self) -> str:
         return f'{self.word} ({self.pos})'
@@ -17,28 +61,262 @@ class Item:
         return [item.word for item in items]
 
 class Dependency:
+
+    __slots__ = ('head', 'tail', 'label_id')
     
     def __init__(self, head, tail, label):
         self.head = head
         self.tail = tail 
-        self.label = label
+        self.label_id = label if isinstance(label, int) else LABELS.code(label)
+
+    @property
+    def label(self):
+        return LABELS.name(self.label_id)
+
+    def __reduce__(self):
+        return Dependency, (self.head, self.tail, self.label)
 
     def __repr__(self) -> str:
         return f'{self.head.word} --({self.label})-> {self.tail.word}'
     
+class DependencyGraph:
+    """
+    Dependencies of a sentence, in the order they were made, indexed by head and by label
+    """
+
+    __slots__ = ('deps', 'by_head', 'by_label')
+
+    def __init__(self, deps):
+        self.deps = list(deps)
+        self.by_head = {} # head item -> its dependencies
+        self.by_label = {} # label code -> dependencies with that label
+        for dep in self.deps:
+            self.by_head.setdefault(dep.head, []).append(dep)
+            self.by_label.setdefault(dep.label_id, []).append(dep)
+
+    def __iter__(self):
+        return iter(self.deps)
+
+    def __len__(self):
+        return len(self.deps)
+
+    def labeled(self, label):
+        """
+        Dependencies with a label (name or code)
+        """
+        code = label if isinstance(label, int) else LABELS.codes.get(label)
+        return self.by_label.get(code, [])
+
+    def dependents(self, head, label=None):
+        """
+        Dependencies of a head item, optionally only those with a label (name or code)
+        """
+        deps = self.by_head.get(head, [])
+        if label is None:
+            return deps
+        code = label if isinstance(label, int) else LABELS.codes.get(label)
+        return [dep for dep in deps if dep.label_id == code]
+
+class Configuration:
+    """
+    State of the shift-reduce parser. The features depending on the whole stack
+    or on the dependencies are updated on each transition, rather than recomputed.
+
+    Items are referred to by their position in the sentence (ROOT at 0):
+    the stack holds positions, and the buffer is the items from position b onwards.
+    """
+
+    __slots__ = ('items', 'stack', 'b', 'deps', 'heads', 'labels', 'children', 'verbs', 'features')
+
+    def __init__(self, items):
+        self.items = items
+        self.stack = []
+        self.b = 0
+        self.deps = []
+
+        # arcs as parallel arrays: head position and label (code) of each item
+        self.heads = [-1] * len(items)
+        self.labels = [None] * len(items)
+        # label codes of the dependents of each item (None: no dependent)
+        self.children = [None] * len(items)
+
+        self.verbs = 0 # number of verbs on the stack
+        self.features = {}
+
+    @property
+    def buffer(self):
+        return self.items[self.b:]
+
+    def stack_items(self):
+        return [self.items[p] for p in self.stack]
+
+    def top(self):
+        return self.items[self.stack[-1]] if self.stack else None
+
+    def front(self):
+        return self.items[self.b] if self.b < len(self.items) else None
+
+    def shift(self):
+        p = self.b
+        self.b += 1
+        self.stack.append(p)
+        if self.items[p].pos_id == VERB:
+            self.verbs += 1
+        return p
+
+    def pop(self, index=-1):
+        p = self.stack.pop(index)
+        if self.items[p].pos_id == VERB:
+            self.verbs -= 1
+        return p
+
+    def arc(self, head, tail, label):
+        self.heads[tail] = head
+        self.labels[tail] = label
+        if self.children[head] is None:
+            self.children[head] = set()
+        self.children[head].add(label)
+
+        dep = Dependency(self.items[head], self.items[tail], label)
+        self.deps.append(dep)
+        return dep
+
 class TransitionClassifier:
+    """
+    Transitions given by rules (a function of the features). With a key function, classify
+    computes the key tuple of the features and looks it up in a table, compiled beforehand
+    (see compile) or filled lazily: on a miss the rules are called and their result stored.
+    """
 
-    def __init__(self, classifier):
+    def __init__(self, classifier, key=None):
 
         # use some predefined rules to classify transitions instead of a machine learning model
         self.classifier = classifier
 
+        # the rules can be compiled to a lookup table, indexed by key(features)
+        # (key must capture every feature the rules look at)
+        # the rules return transitions as text, the table holds their codes
+        self.key = key
+        self.table = {}
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['table'] = {key: decode_transition(code) for key, code in self.table.items()}
+        return state
+
+    def __setstate__(self, state):
+        state['table'] = {key: encode_transition(t) for key, t in state['table'].items()}
+        self.__dict__.update(state)
+
+    def compile(self, feature_space):
+        """
+        Precompute the transitions given by the rules for the features in feature_space
+        """
+        for features in feature_space:
+            try:
+                self.table[self.key(features)] = encode_transition(self.classifier(features))
+            except Exception:
+                # no transition for these features, the rules will raise at parse time
+                pass
+
+    def verify(self, feature_space):
+        """
+        Compare the compiled table with the rules, returns the features they disagree on
+        """
+        mismatches = []
+        for features in feature_space:
+            key = self.key(features)
+            try:
+                transition = encode_transition(self.classifier(features))
+            except Exception:
+                transition = None
+            if self.table.get(key) != transition:
+                mismatches.append(features)
+        return mismatches
+
     def classify(self, features):
-        return self.classifier(features)
+        """
+        Code of the transition for the features, see encode_transition
+        """
+        if self.key is None:
+            return encode_transition(self.classifier(features))
+
+        key = self.key(features)
+        try:
+            return self.table[key]
+        except KeyError:
+            transition = self.table[key] = encode_transition(self.classifier(features))
+            return transition
 
     def describe(self):
         return self.classifier.__doc__
 
+class Trace:
+    """
+    Transitions taken while parsing a sentence, as (transition code, stack top, buffer head,
+    arc) tuples: positions of the items after the transition (-1: empty stack) and index
+    of the last dependency it created in deps (-1: none). Rendered as a table only on request.
+    """
+
+    __slots__ = ('sentence', 'items', 'deps', 'steps')
+
+    def __init__(self, sentence, items, deps):
+        self.sentence = sentence
+        self.items = items
+        self.deps = deps
+        self.steps = []
+
+    def __len__(self):
+        return len(self.steps)
+
+    def render(self):
+        """
+        The table of the transitions, with the stack and the buffer after each one
+        (replayed from the transition codes)
+        """
+        items = self.items
+        lines = [
+            '-----------------------------------\n',
+            f"Parsing: {self.sentence}\n",
+            '-----------------------------------\n',
+            f'Tokens: {Item.dump(items)}\n\n',
+        ]
+
+        stack = []
+        for transition, _, b, arc in self.steps:
+            kind = transition & KIND
+            if kind == SHIFT or kind == RIGHT_ARC:
+                stack.append(b - 1)
+            else:
+                stack.pop()
+            if b == len(items):
+                # root dependency
+                del stack[:2]
+
+            lines.append("{0:<15} {1:<40} {2:<80} {3:<40}\n".format(
+                TRANSITIONS.name(kind),
+                str([items[p].word for p in stack]),
+                str(Item.words(items[b:])),
+                str(self.deps[arc]) if arc >= 0 else ''
+            ))
+
+        lines.append('-----------------------------------\n')
+        return ''.join(lines)
+
+class ParseResult:
+
+    __slots__ = ('sentence', 'tokens', 'pos_tags', 'deps', 'trace')
+
+    def __init__(self, sentence, tokens, pos_tags, deps, trace=None):
+        self.sentence = sentence
+        self.tokens = tokens
+        self.pos_tags = pos_tags
+        self.deps = deps
+        self.trace = trace
+
+    def __repr__(self) -> str:
+        return f'{self.sentence}: {self.deps}'
+
 class DependencyGrammar:
 
     GRAMMAR_FILE = 'output/p2-q-1.txt'
@@ -73,58 +351,105 @@ Transition function: A function that takes a dictionary of features and returns
 
 """)
 
-    def parse(self, sent, save=False):
-    
+    def parse(self, sent, save=False, writer=None):
+
+        if save and writer is None:
+            with OutputWriter(self.PARSE_FILE, 'a') as writer:
+                return self.parse(sent, save=save, writer=writer)
+
+        result = self.analyze(sent, writer=writer if save else None)
+        self.tokens = result.tokens
+        self.pos_tags = result.pos_tags
+        self.deps = result.deps
+
+        print("Parsing completed. Check out the variables 'tokens', 'pos_tags', and 'deps'.")
+        return result
+
+    def analyze(self, sent, writer=None, trace=False):
+        """
+        Parse a sentence without touching the grammar state, returns a ParseResult.
+        With trace, the transitions are recorded in its trace; the table of the
+        transitions is written to writer if given.
+        """
         # tokenize
-        self.tokens = self.tokenizer.tokenize(sent)
+        with instrument.span('tokenize'):
+            tokens = self.tokenizer.tokenize(sent)
+
+        return self.analyze_tokens(tokens, sent, writer=writer, trace=trace)
+
+    @instrument.profiled('parse')
+    def analyze_tokens(self, tokens, sent=None, writer=None, trace=False):
+        """
+        Parse an already tokenized sentence, see analyze
+        """
+        if sent is None:
+            sent = ' '.join(tokens)
 
         # part-of-speech tagging
-        self.pos_tags = self.pos_tagger.tag(self.tokens)
+        with instrument.span('tag'):
+            pos_tags = self.pos_tagger.tag(tokens)
 
         # initialize the parser
-        stack = []
-        buffer = [Item(0, 'ROOT', 'ROOT')] + [
+        config = Configuration([Item(0, 'ROOT', 'ROOT')] + [
             Item(index, word, pos)
-            for index, (word, pos) in enumerate(zip(self.tokens, self.pos_tags))
-        ]
-        self.deps = []
+            for index, (word, pos) in enumerate(zip(tokens, pos_tags))
+        ])
 
-        if save:
-            with open(self.PARSE_FILE, 'a', encoding='utf-8') as f:
-                f.write('-----------------------------------\n')
-                f.write(f"Parsing: {sent}\n")
-                f.write('-----------------------------------\n')
-                f.write(f'Tokens: {Item.dump(buffer)}\n\n')
+        steps = None
+        if trace or writer is not None:
+            trace = Trace(sent, config.items, config.deps)
+            steps = trace.steps
+        else:
+            trace = None
 
         # shift-reduce parsing
-        while buffer:
-            features = self.extract_features(stack, buffer)
-            transition = self.transition_classifier.classify(features)
-            self.apply_transition(transition, stack, buffer, self.deps, save=save)
-
-        if save:
-            with open(self.PARSE_FILE, 'a', encoding='utf-8') as f:
-                f.write('-----------------------------------\n')
-                # f.write('Dependencies:\n')
-                # Item.dump(dependencies)
-
-        print("Parsing completed. Check out the variables 'tokens', 'pos_tags', and 'deps'.")
+        profiler = instrument.current()
+        with instrument.span('transitions'):
+            while config.b < len(config.items):
+                features = self.extract_features(config)
+                transition = self.transition_classifier.classify(features)
+                arcs = len(config.deps)
+                self.apply_transition(transition, config)
+                if steps is not None:
+                    steps.append((
+                        transition,
+                        config.stack[-1] if config.stack else -1,
+                        config.b,
+                        len(config.deps) - 1 if len(config.deps) > arcs else -1,
+                    ))
+                if profiler is not None:
+                    profiler.count(TRANSITIONS.name(transition & KIND))
+
+        if writer is not None:
+            writer.write(trace.render())
+
+        return ParseResult(sent, tokens, pos_tags, config.deps, trace)
     
     def parse_all(self, sent, save=False):
 
-        if save:
-            with open(self.PARSE_FILE, 'w', encoding='utf-8') as f:
-                f.write('')
-
         dep_lists = []
 
-        for s in sent:
-            self.parse(s, save=save)
-            dep_lists.append(self.deps)
+        with OutputWriter(self.PARSE_FILE if save else None, 'w') as writer:
+            for s in sent:
+                self.parse(s, save=save, writer=writer)
+                dep_lists.append(self.deps)
 
         return dep_lists
+
+    def parse_batch(self, sentences, workers=None, chunksize=64):
+        """
+        Parse many sentences, returns their ParseResults in the same order.
+        With workers > 1, the sentences are parsed by a pool of processes.
+        """
+        if not workers or workers <= 1:
+            return [self.analyze(sent) for sent in sentences]
+
+        with ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_worker, initargs=(self,)
+        ) as executor:
+            return list(executor.map(_analyze, sentences, chunksize=chunksize))
     
-    def extract_features(self, stack, buffer):
+    def extract_features(self, config):
         """
 - Features:
     - sword: The word on top of the stack.
@@ -134,25 +459,27 @@ Transition function: A function that takes a dictionary of features and returns
     - sindex: The index of the word on top of the stack.
     - bindex: The index of the first word in the buffer.
     - has_main_verb: Whether the stack contains a main verb.
+    - has_case: Whether the word on top of the stack has a case dependent.
         """
         
-        features = {}
-
-        features['deps'] = self.deps
-        features['sword'] = stack[-1].word if stack else None
-        features['bword'] = buffer[0].word if buffer else None
-        features['spos'] = stack[-1].pos if stack else None
-        features['bpos'] = buffer[0].pos if buffer else None
-        features['sindex'] = stack[-1].index if stack else None
-        features['bindex'] = buffer[0].index if buffer else None
-        features['has_main_verb'] = any([
-            item.pos == 'V'
-            for item in stack[:-1]
-        ])
+        s = config.top()
+        b = config.front()
+        features = config.features
+
+        features['sword'] = s.word if s else None
+        features['bword'] = b.word if b else None
+        features['spos'] = s.pos if s else None
+        features['bpos'] = b.pos if b else None
+        features['sindex'] = s.index if s else None
+        features['bindex'] = b.index if b else None
+        features['has_main_verb'] = config.verbs - (s.pos == 'V') > 0 if s else False
+        features['has_case'] = (
+            CASE in (config.children[config.stack[-1]] or ()) if s else False
+        )
 
         return features
 
-    def apply_transition(self, transition, stack, buffer, dependencies, save=False):
+    def apply_transition(self, transition, config):
         """
 - Transitions:
 
@@ -162,43 +489,38 @@ Transition function: A function that takes a dictionary of features and returns
     - REDUCE: Remove the word on top of the stack.
         """
 
-        new_dep = None
-
-        if transition == 'SHIFT':
-            stack.append(buffer.pop(0))
-        elif transition.startswith('LEFT_ARC'):
-            head = buffer[0]
-            tail = stack.pop(-1)
-            label = transition.split()[1]
-            new_dep = Dependency(head, tail, label)
-            dependencies.append(new_dep)
-        elif transition.startswith('RIGHT_ARC'):
-            head = stack[-1]
-            tail = buffer.pop(0)
-            label = transition.split()[1]
-            new_dep = Dependency(head, tail, label)
-            dependencies.append(new_dep)
-            stack.append(tail)
-        elif transition == 'REDUCE':
-            if not stack:
-                Item.dump(buffer)
-            stack.pop(-1)
+        # a transition code, or its text
+        if isinstance(transition, str):
+            transition = encode_transition(transition)
+        kind = transition & KIND
+
+        if kind == SHIFT:
+            config.shift()
+        elif kind == LEFT_ARC:
+            head = config.b
+            tail = config.pop()
+            config.arc(head, tail, transition >> 2)
+        elif kind == RIGHT_ARC:
+            head = config.stack[-1]
+            tail = config.shift()
+            config.arc(head, tail, transition >> 2)
         else:
-            raise ValueError(f'Invalid transition: {transition}')
+            if not config.stack:
+                Item.dump(config.buffer)
+            config.pop()
         
-        if not buffer:
+        if config.b == len(config.items):
             # add root dependency
-            head = stack.pop(0)
-            tail = stack.pop(0)
-            new_dep = Dependency(head, tail, 'root')
-            dependencies.append(new_dep)
-        
-        if save:
-            with open(self.PARSE_FILE, 'a', encoding='utf-8') as f:
-                
-                f.write("{0:<15} {1:<40} {2:<80} {3:<40}\n".format(
-                        transition.split()[0],
-                        str(Item.words(stack)),
-                        str(Item.words(buffer)),
-                        str(new_dep) if new_dep else ''
-                ))
\ No newline at end of file
+            head = config.pop(0)
+            tail = config.pop(0)
+            config.arc(head, tail, LABELS.root)
+
+# grammar of the worker processes of DependencyGrammar.parse_batch
+_worker_grammar = None
+
+def _init_worker(grammar):
+    global _worker_grammar
+    _worker_grammar = grammar
+
+def _analyze(sent):
+    return _worker_grammar.analyze(sent)
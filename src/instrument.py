@@ -0,0 +1,113 @@
+"""
+Optional instrumentation of the pipeline stages.
+
+Functions decorated with @profiled(name), and blocks in span(name), are timed by the
+active Profiler, if any. Without an active profiler, a decorated function costs one more
+call and a global lookup, and a span a call returning a shared null context manager.
+
+    profiler = instrument.enable()
+    ... answer questions ...
+    instrument.disable()
+    print(profiler.to_json())     # counts and wall time of each stage (nested)
+    print(profiler.folded())      # folded stacks, for flamegraph.pl or speedscope
+"""
+
+import functools
+import json
+import time
+from contextlib import contextmanager, nullcontext
+
+_profiler = None
+_null = nullcontext()
+
+class Profiler:
+    """
+    Call counts and wall times of nested spans, and event counters (e.g. transitions)
+    """
+
+    def __init__(self):
+        self.spans = {} # path of span names -> [count, total seconds]
+        self.counters = {}
+        self.path = ()
+
+    @contextmanager
+    def span(self, name):
+        parent = self.path
+        self.path = path = parent + (name,)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.path = parent
+            stat = self.spans.get(path)
+            if stat is None:
+                self.spans[path] = [1, elapsed]
+            else:
+                stat[0] += 1
+                stat[1] += elapsed
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def to_dict(self):
+        return {
+            'spans': [
+                {'path': list(path), 'count': count, 'seconds': total}
+                for path, (count, total) in sorted(self.spans.items())
+            ],
+            'counters': dict(sorted(self.counters.items())),
+        }
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.to_dict(), ensure_ascii=False, **kwargs)
+
+    def folded(self):
+        """
+        Folded stacks ("parse;tokenize 42"), weighted by self time in microseconds
+        """
+        children = {}
+        for path, (_, total) in self.spans.items():
+            if len(path) > 1:
+                children[path[:-1]] = children.get(path[:-1], 0) + total
+
+        return ''.join([
+            f"{';'.join(path)} {max(0, round((total - children.get(path, 0)) * 1e6))}\n"
+            for path, (_, total) in sorted(self.spans.items())
+        ])
+
+def enable(profiler=None):
+    """
+    Start recording with a profiler (a new one by default), returns it
+    """
+    global _profiler
+    _profiler = profiler or Profiler()
+    return _profiler
+
+def disable():
+    global _profiler
+    _profiler = None
+
+def current():
+    """
+    The active profiler, or None
+    """
+    return _profiler
+
+def span(name):
+    return _profiler.span(name) if _profiler is not None else _null
+
+def profiled(name):
+    """
+    Decorator timing every call of a function as a span
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            profiler = _profiler
+            if profiler is None:
+                return func(*args, **kwargs)
+            with profiler.span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
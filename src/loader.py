@@ -0,0 +1,82 @@
+import re
+from collections import deque
+from src.database import Database
+
+# tokens of the fact format: (PRED arg "quoted arg" ...)
+TOKEN = re.compile(r'\(|\)|"[^"]*"|"|[^\s()"]+')
+
+def iter_facts(lines):
+    """
+    Parse facts from an iterable of lines (e.g. an open file), in a single streaming pass.
+    Yields each fact as a tuple (predicate, *arguments), a fact may span several lines.
+    """
+    fact = None
+
+    for lineno, line in enumerate(lines, 1):
+        for match in TOKEN.finditer(line):
+            token = match.group()
+
+            if token == '(':
+                if fact is not None:
+                    raise ValueError(f'Line {lineno}: nested facts are not supported')
+                fact = []
+            elif token == ')':
+                if not fact:
+                    raise ValueError(f'Line {lineno}: unexpected ")"')
+                yield tuple(fact)
+                fact = None
+            elif token == '"':
+                raise ValueError(f'Line {lineno}: unterminated string')
+            elif fact is None:
+                raise ValueError(f'Line {lineno}: value outside of a fact: {token}')
+            else:
+                fact.append(token[1:-1] if token[0] == '"' else token)
+
+    if fact is not None:
+        raise ValueError('Unterminated fact at the end of the input')
+
+def load_facts(facts, database=None):
+    """
+    Store facts in a Database, one relation per predicate, except:
+
+    - DTIME and ATIME facts of a tour are paired into TIME (tour, dloc, dtime, aloc, atime)
+    - RUN-TIME durations are kept as one value (e.g. "2:00 HR")
+
+    The times and durations are parsed to integers (minutes) by the Database, see temporal.
+    """
+    relations = {'TOUR': [], 'TIME': [], 'RUN-TIME': [], 'BY': []}
+    departures = {} # tour -> DTIME facts waiting for their ATIME
+
+    for pred, *args in facts:
+
+        if pred == 'DTIME':
+            departures.setdefault(args[0], deque()).append(args)
+            continue
+
+        if pred == 'ATIME' and departures.get(args[0]):
+            tour, dloc, dtime = departures[args[0]].popleft()
+            relations['TIME'].append((tour, dloc, dtime, args[1], args[2]))
+            continue
+
+        if pred == 'RUN-TIME' and len(args) > 4:
+            args = args[:3] + [' '.join(args[3:])]
+
+        relations.setdefault(pred, []).append(tuple(args))
+
+    # departures without arrival
+    for pending in departures.values():
+        if pending:
+            relations.setdefault('DTIME', []).extend(tuple(args) for args in pending)
+
+    if database is None:
+        return Database(relations)
+    for name, records in relations.items():
+        database.add(name, records)
+    return database
+
+def load(filename, database=None):
+    """
+    Load the facts of a database file (e.g. input/database.txt)
+    """
+    with open(filename, 'r', encoding='utf-8') as f:
+        return load_facts(iter_facts(f), database)
@@ -0,0 +1,93 @@
+from src import vacatio
+from src.procedure import ProcedureCache
+from src.util import LRUCache
+
+class PipelineResult:
+
+    __slots__ = ('question', 'tokens', 'deps', 'relations', 'logical_form', 'procedure', 'answer')
+
+    def __init__(self, question):
+        self.question = question
+        self.tokens = None
+        self.deps = None
+        self.relations = None
+        self.logical_form = None
+        self.procedure = None
+        self.answer = None
+
+    def __repr__(self) -> str:
+        return f'{self.question}: {self.answer}'
+
+class Pipeline:
+    """
+    Question answering pipeline:
+
+        question -> tokens -> dependencies -> relations -> logical form -> procedure -> answer
+
+    Each stage is cached in a bounded LRU cache, keyed by the content of its input
+    (e.g. the dependencies are keyed by the tokens), so questions that only differ
+    before tokenization (spacing, punctuation attached to a word) share the later stages.
+    The results of the stages are shared between the questions, and must not be modified.
+    """
+
+    STAGES = ['tokens', 'deps', 'relations', 'logical_form', 'procedure']
+
+    def __init__(self, grammar=None, database=None, maxsize=1024):
+        self.grammar = grammar or vacatio.dependency_grammar()
+        self.database = database
+        self.caches = {stage: LRUCache(maxsize) for stage in self.STAGES}
+        self.results = ProcedureCache(maxsize)
+
+    def _cached(self, stage, key, compute):
+        cache = self.caches[stage]
+        value = cache.get(key)
+        if value is None:
+            value = compute()
+            cache.put(key, value)
+        return value
+
+    def run(self, question):
+        """
+        Answer a question, returns a PipelineResult with the output of every stage
+        """
+        result = PipelineResult(question)
+
+        text = ' '.join(question.split())
+        result.tokens = self._cached(
+            'tokens', text,
+            lambda: tuple(self.grammar.tokenizer.tokenize(text))
+        )
+        result.deps = self._cached(
+            'deps', result.tokens,
+            lambda: self.grammar.analyze_tokens(list(result.tokens), question).deps
+        )
+        result.relations = self._cached(
+            'relations', tuple(
+                (dep.head.word, dep.head.pos, dep.label, dep.tail.word, dep.tail.pos)
+                for dep in result.deps
+            ),
+            lambda: vacatio.relationalize(result.deps)
+        )
+        result.logical_form = self._cached(
+            'logical_form', repr(result.relations),
+            lambda: vacatio.logicalize(result.relations)
+        )
+        result.procedure = self._cached(
+            'procedure', repr(result.logical_form),
+            lambda: vacatio.proceduralize(result.logical_form)
+        )
+
+        if self.database is not None:
+            result.answer = vacatio.answer(result.procedure, self.database, self.results)
+
+        return result
+
+    def clear(self):
+        for cache in self.caches.values():
+            cache.clear()
+        self.results.invalidate()
+
+    def stats(self):
+        stats = {stage: cache.stats() for stage, cache in self.caches.items()}
+        stats['results'] = self.results.stats()
+        return stats
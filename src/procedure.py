@@ -1,3 +1,7 @@
+from src import instrument, temporal
+from src.database import Database, Range
+from src.util import LRUCache
+
 class Procedure:
     """
     Represents a procedural semantic form that interacts with the database.
@@ -5,14 +9,159 @@ class Procedure:
     - SELECT <query> FROM <data> WHERE <criteria>: select items from the database that match the criteria
     - FILTER <data> BY <criteria>: filter items from the database that match the criteria
     - data: TOUR | DTIME | ATIME | RUN-TIME | BY
+
+    Procedures can be chained with join: the next procedures of the chain restrict the
+    records of the first one to the tours (first column) they also match.
     """
 
+    KEY = 0 # column shared by the relations, used to join them (tour)
+
     def __init__(self, action):
         self.action = action
         self.next = None # next procedure in the sequence
 
+    @instrument.profiled('execute')
     def execute(self, database):
+        records = self.match(database) if self.next is None else self.plan(database)
+        return self.output(records)
+
+    def output(self, records):
         raise NotImplementedError
+
+    def key(self):
+        """
+        Canonical form of the procedure (and its chain), e.g. to cache its results
+        """
+        return tuple(
+            (
+                proc.action,
+                proc.data,
+                tuple(proc.query) if type(getattr(proc, 'query', None)) in [list, tuple]
+                else getattr(proc, 'query', None),
+                tuple(proc.criteria),
+            )
+            for proc in self.chain()
+        )
+
+    def join(self, proc):
+        """
+        Append a procedure to the chain, returns self
+        """
+        last = self
+        while last.next is not None:
+            last = last.next
+        last.next = proc
+        return self
+
+    def chain(self):
+        proc = self
+        while proc is not None:
+            yield proc
+            proc = proc.next
+
+    def match(self, database):
+        """
+        Records of self.data matching self.criteria (None matches any value,
+        a Range any value between its bounds)
+        """
+        if isinstance(database, Database):
+            return database.match(self.data, self.criteria)
+
+        return [
+            rec for rec in database[self.data]
+            if all([
+                c is None or (self._within(i, r, c) if isinstance(c, Range) else r == c)
+                for i, (r, c) in enumerate(zip(rec, self.criteria))
+            ])
+        ]
+
+    def _within(self, column, value, bounds):
+        parse = temporal.COLUMNS.get((self.data, column))
+        if parse is not None:
+            value = temporal.parse_or_missing(parse, value)
+            if value == temporal.MISSING:
+                return False
+        low, high = [
+            parse(bound) if parse is not None and isinstance(bound, str) else bound
+            for bound in bounds
+        ]
+        return (low is None or low <= value) and (high is None or value <= high)
+
+    def probe(self, database, keys):
+        """
+        Records matching self.criteria with a key in keys, looked up by the database
+        (key by key in its indexes). Returns them in database order.
+        """
+        records = database[self.data]
+        return [records[rid] for rid in database.probe(self.data, self.criteria, self.KEY, keys)]
+
+    def estimate(self, database):
+        """
+        Estimated number of records matched by this procedure alone
+        """
+        if isinstance(database, Database):
+            return database.estimate(self.data, self.criteria)
+        return len(database[self.data])
+
+    def plan(self, database):
+        """
+        Execute the chain as a join on the key column: the procedures are evaluated from
+        the most to the least selective, each one probing only the keys left by the
+        previous ones (with the indexes of the database) or, when it is smaller, being
+        evaluated fully and hash-joined on the keys.
+        Returns the records of this procedure, in database order.
+        """
+        keys = None
+        records = None
+
+        # each estimate is computed once
+        chain = sorted((proc.estimate(database), i, proc) for i, proc in enumerate(self.chain()))
+
+        for estimate, _, proc in chain:
+
+            if keys is None or not isinstance(database, Database) or estimate <= len(keys):
+                matched = proc.match(database)
+                if keys is not None:
+                    matched = [rec for rec in matched if rec[self.KEY] in keys]
+            else:
+                matched = proc.probe(database, keys)
+
+            if proc is self:
+                records = matched
+            keys = {rec[self.KEY] for rec in matched}
+            if not keys:
+                return []
+
+        return [rec for rec in records if rec[self.KEY] in keys]
+
+    def pattern(self, criteria):
+        """
+        Database pattern of the criteria, e.g. (BY PQ *)
+        """
+        if self.data == 'TIME':
+            # special case: (DTIME * * *) (ATIME * * *)
+
+            return (
+                '(DTIME' + 
+                ' ' + (str(criteria[0]) if criteria[0] else '*') +
+                ' ' + (str(criteria[1]) if criteria[1] else '*') +
+                ' ' + (str(criteria[2]) if criteria[2] else '*') +
+                ') (ATIME' +
+                ' ' + (str(criteria[0]) if criteria[0] else '*') +
+                ' ' + (str(criteria[3]) if criteria[3] else '*') +
+                ' ' + (str(criteria[4]) if criteria[4] else '*') +
+                ')'
+            )
+
+        return (
+            f'({self.data} ' +
+            ' '.join(
+                [str(x) if x else '*' for x in criteria]
+            ) + ')'
+        )
+
+    def _joins(self):
+        return ''.join([f' JOIN {proc.pattern(proc.criteria)}' for proc in self.chain() if proc is not self])
     
 class SelectProcedure(Procedure):
 
@@ -22,21 +171,16 @@ class SelectProcedure(Procedure):
         self.data = data
         self.criteria = criteria
 
-    def execute(self, database):
+    def output(self, records):
         
-        records = database[self.data]
         result = []
 
         for rec in records:
             
-            if all([
-                r == c or c is None
-                for r, c in zip(rec, self.criteria)
-            ]):
-                if type(self.query) in [list, tuple]:
-                    result.append([rec[q - 1] for q in self.query])
-                else:
-                    result.append(rec[self.query - 1])
+            if type(self.query) in [list, tuple]:
+                result.append([rec[q - 1] for q in self.query])
+            else:
+                result.append(rec[self.query - 1])
 
         return result
 
@@ -57,31 +201,8 @@ class SelectProcedure(Procedure):
         pattern = self.criteria.copy()
         for i, v in var.items():
             pattern[i - 1] = v
-        c = None
-        if self.data == 'TIME':
-            # special case: (DTIME * * *) (ATIME * * *)
-
-            c = (
-                '(DTIME' + 
-                ' ' + (pattern[0] if pattern[0] else '*') +
-                ' ' + (pattern[1] if pattern[1] else '*') +
-                ' ' + (pattern[2] if pattern[2] else '*') +
-                ') (ATIME' +
-                ' ' + (pattern[0] if pattern[0] else '*') +
-                ' ' + (pattern[3] if pattern[3] else '*') +
-                ' ' + (pattern[4] if pattern[4] else '*') +
-                ')'
-            )
-
-        else:
-            c = (
-                f'({self.data} ' +
-                ' '.join(
-                    [str(x) if x else '*' for x in pattern]
-                ) + ')'
-            )
 
-        return f'SELECT {q} {c}'        
+        return f'SELECT {q} {self.pattern(pattern)}{self._joins()}'        
     
 class FilterProcedure(Procedure):
 
@@ -90,46 +211,41 @@ class FilterProcedure(Procedure):
         self.data = data
         self.criteria = criteria
 
-    def execute(self, database):
-        
-        records = database[self.data]
-        result = []
+    def output(self, records):
+        return records
 
-        for rec in records:
-            
-            if all([
-                r == c or c is None
-                for r, c in zip(rec, self.criteria)
-            ]):
-                result.append(rec)
+    def __repr__(self):
+        return f'FILTER {self.pattern(self.criteria)}{self._joins()}'
 
-        return result
 
-    def __repr__(self):
-        
-        c = None
+class ProcedureCache:
+    """
+    Bounded LRU cache of the results of executed procedures, keyed by their canonical form.
+    The cache is emptied when it is used with another database, or when the database changes.
+    """
 
-        if self.data == 'TIME':
+    def __init__(self, maxsize=1024):
+        self.cache = LRUCache(maxsize)
+        self.database = None
+        self.version = None
 
-            c = (
-                '(DTIME' + 
-                ' ' + (self.criteria[0] if self.criteria[0] else '*') +
-                ' ' + (self.criteria[1] if self.criteria[1] else '*') +
-                ' ' + (self.criteria[2] if self.criteria[2] else '*') +
-                ') (ATIME' +
-                ' ' + (self.criteria[0] if self.criteria[0] else '*') +
-                ' ' + (self.criteria[3] if self.criteria[3] else '*') +
-                ' ' + (self.criteria[4] if self.criteria[4] else '*') +
-                ')'
-            )
+    def execute(self, proc, database):
 
-        else:
+        version = getattr(database, 'version', None)
+        if database is not self.database or version != self.version:
+            self.invalidate()
+            self.database = database
+            self.version = version
 
-            c = (
-                f'({self.data} ' +
-                ' '.join(
-                    [str(x) if x else '*' for x in self.criteria]
-                ) + ')'
-            )
+        key = proc.key()
+        result = self.cache.get(key)
+        if result is None:
+            result = proc.execute(database)
+            self.cache.put(key, result)
+        return result
+
+    def invalidate(self):
+        self.cache.clear()
 
-        return f'FILTER {c}'
+    def stats(self):
+        return self.cache.stats()
@@ -0,0 +1,171 @@
+"""
+Question answering server, keeping the grammar, the database and the caches warm.
+
+Line protocol (UTF-8), over a Unix socket or TCP:
+
+- request: one question per line, or STATS
+- response: one JSON object per line, {"answer", "procedure", "latency_ms"} or {"error"};
+  STATS returns the latency percentiles and the cache statistics
+
+Questions are answered by a pool of worker processes (--workers), each with its own
+pipeline and caches, so a slow question does not hold up the other clients.
+With --workers 0 they are answered on the event loop, one at a time.
+
+Run with: python -m src.server --socket /tmp/vacatio.sock (or --port 5000)
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from src import snapshot, vacatio
+from src.pipeline import Pipeline
+
+DATABASE_FILE = 'input/database.txt'
+
+def percentile(values, p):
+    """
+    Nearest-rank percentile of sorted values
+    """
+    if not values:
+        return None
+    k = math.ceil(p / 100 * len(values)) - 1
+    return values[min(max(k, 0), len(values) - 1)]
+
+def make_pipeline(database=DATABASE_FILE, cache_size=1024, lexicon=None):
+    return Pipeline(
+        grammar=vacatio.dependency_grammar(lexicon),
+        database=snapshot.load_cached(database),
+        maxsize=cache_size,
+    )
+
+def run(pipeline, question):
+    result = pipeline.run(question)
+    return {'answer': result.answer, 'procedure': repr(result.procedure)}
+
+# pipeline of the worker processes
+_worker_pipeline = None
+
+def _init_worker(*options):
+    global _worker_pipeline
+    _worker_pipeline = make_pipeline(*options)
+
+def _run(question):
+    return run(_worker_pipeline, question)
+
+class QuestionServer:
+    """
+    Answers the questions with pipeline, or in the worker processes of executor if given
+    (see worker_pool); the cache statistics are then those of each worker, not reported.
+    """
+
+    def __init__(self, pipeline=None, window=10000, executor=None):
+        self.pipeline = pipeline
+        self.executor = executor
+        self.latencies = deque(maxlen=window) # seconds, of the last answered questions
+        self.requests = 0
+        self.errors = 0
+
+    async def answer(self, question):
+
+        start = time.perf_counter()
+        self.requests += 1
+        try:
+            if self.executor is None:
+                response = run(self.pipeline, question)
+            else:
+                loop = asyncio.get_running_loop()
+                response = await loop.run_in_executor(self.executor, _run, question)
+        except Exception as e:
+            self.errors += 1
+            response = {'error': f'{type(e).__name__}: {e}'}
+        latency = time.perf_counter() - start
+
+        self.latencies.append(latency)
+        response['latency_ms'] = latency * 1000
+        return response
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'latency_ms': {
+                f'p{p}': percentile(latencies, p) * 1000 if latencies else None
+                for p in [50, 90, 99, 99.9]
+            },
+            'caches': self.pipeline.stats() if self.executor is None else None,
+        }
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                question = line.decode('utf-8').strip()
+                if not question:
+                    continue
+
+                response = self.stats() if question == 'STATS' else await self.answer(question)
+                writer.write(json.dumps(response, ensure_ascii=False).encode('utf-8') + b'\n')
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, path=None, host='127.0.0.1', port=5000):
+        if path:
+            server = await asyncio.start_unix_server(self.handle, path=path)
+        else:
+            server = await asyncio.start_server(self.handle, host=host, port=port)
+        async with server:
+            await server.serve_forever()
+
+def worker_pool(workers, database=DATABASE_FILE, cache_size=1024, lexicon=None):
+    """
+    Pool of processes answering questions, each with its own pipeline
+    """
+    return ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_worker,
+        initargs=(database, cache_size, lexicon),
+    )
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Question answering server')
+    parser.add_argument('--socket', help='path of the Unix socket to listen on')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--database', default=DATABASE_FILE)
+    parser.add_argument('--cache-size', type=int, default=1024)
+    parser.add_argument('--lexicon', help='file of extra words (TAG -> word | word ...)')
+    parser.add_argument(
+        '--workers', type=int, default=os.cpu_count() or 1,
+        help='worker processes answering the questions (0: answer on the event loop)'
+    )
+    args = parser.parse_args()
+
+    options = (args.database, args.cache_size, args.lexicon)
+    if args.workers > 0:
+        # build the snapshot once, before the workers open it
+        snapshot.load_cached(args.database)
+        executor = worker_pool(args.workers, *options)
+        server = QuestionServer(executor=executor)
+    else:
+        executor = None
+        server = QuestionServer(make_pipeline(*options))
+
+    try:
+        asyncio.run(server.serve(args.socket, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+if __name__ == '__main__':
+    main()
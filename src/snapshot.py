@@ -0,0 +1,266 @@
+"""
+Binary columnar snapshot of a Database, opened with mmap.
+
+Layout (little-endian, sections aligned to 8 bytes):
+
+- header: magic, version, size / mtime (ns) / sha1 of the source file
+- strings: count, count + 1 offsets (u64), utf-8 blob; every value is interned once
+- relations: count, then for each relation: name id (u32), arity (u32), rows (u64),
+  one column of string ids (u32) per argument, then the typed columns (see
+  Database.values): count (u64), and for each one its position (u64) and values (i64)
+"""
+
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+from array import array
+from src import loader
+from src.database import Database
+
+MAGIC = b'VACSNAP1'
+VERSION = 2
+HEADER = struct.Struct('<8sIIQq20s4x')
+MTIME = 24 # offset of the mtime in the header
+
+def _digest(filename):
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.digest()
+
+def _pad(f):
+    f.write(b'\0' * (-f.tell() % 8))
+
+def save(database, filename, source=None):
+    """
+    Write a snapshot of the database, stamped with the source file it was loaded from
+    """
+    strings = {}
+    def intern(value):
+        if value not in strings:
+            strings[value] = len(strings)
+        return strings[value]
+
+    relations = []
+    for name in database.keys():
+        records = database[name]
+        arity = len(records[0]) if len(records) else 0
+        if any(len(rec) != arity for rec in records):
+            # the columns need one arity per relation
+            raise ValueError(f'Records of {name} have different numbers of arguments')
+        columns = [array('I', [intern(rec[c]) for rec in records]) for c in range(arity)]
+        typed = [
+            (column, array('q', values))
+            for (relation, column), values in sorted(database.values.items())
+            if relation == name
+        ]
+        relations.append((intern(name), arity, len(records), columns, typed))
+
+    size, mtime, sha1 = 0, 0, b'\0' * 20
+    if source:
+        stat = os.stat(source)
+        size, mtime, sha1 = stat.st_size, stat.st_mtime_ns, _digest(source)
+
+    blobs = [value.encode('utf-8') for value in strings]
+    offsets = array('Q', [0])
+    for blob in blobs:
+        offsets.append(offsets[-1] + len(blob))
+
+    # a temporary file of its own, so concurrent writers do not mix their snapshots
+    fd, tmp = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(filename)),
+        prefix=os.path.basename(filename) + '.', suffix='.tmp'
+    )
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            _write(f, size, mtime, sha1, blobs, offsets, relations)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, filename)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+def _write(f, size, mtime, sha1, blobs, offsets, relations):
+    f.write(HEADER.pack(MAGIC, VERSION, 0, size, mtime, sha1))
+
+    f.write(struct.pack('<Q', len(blobs)))
+    offsets.tofile(f)
+    f.write(b''.join(blobs))
+    _pad(f)
+
+    f.write(struct.pack('<Q', len(relations)))
+    for name_id, arity, rows, columns, typed in relations:
+        f.write(struct.pack('<IIQ', name_id, arity, rows))
+        for column in columns:
+            column.tofile(f)
+        _pad(f)
+        f.write(struct.pack('<Q', len(typed)))
+        for column, values in typed:
+            f.write(struct.pack('<Q', column))
+            values.tofile(f)
+
+def is_fresh(filename, source):
+    """
+    Whether the snapshot was made from the current content of the source file:
+    same size and mtime, or (if only the mtime changed) same sha1, in which case
+    the new mtime is recorded so the source is not hashed again
+    """
+    try:
+        with open(filename, 'rb') as f:
+            magic, version, _, size, mtime, sha1 = HEADER.unpack(f.read(HEADER.size))
+        stat = os.stat(source)
+    except (OSError, struct.error):
+        return False
+
+    if magic != MAGIC or version != VERSION or size != stat.st_size:
+        return False
+    if mtime == stat.st_mtime_ns:
+        return True
+    if sha1 != _digest(source):
+        return False
+
+    try:
+        with open(filename, 'r+b') as f:
+            f.seek(MTIME)
+            f.write(struct.pack('<q', stat.st_mtime_ns))
+    except OSError:
+        pass
+    return True
+
+def load_cached(source, filename=None):
+    """
+    Open the snapshot of a database file, (re)building it from the source if it is stale.
+    If the snapshot cannot be written (e.g. a relation with records of different arities),
+    the database loaded from the source is returned.
+    """
+    filename = filename or source + '.snap'
+    if is_fresh(filename, source):
+        return SnapshotDatabase(filename)
+
+    database = loader.load(source)
+    try:
+        save(database, filename, source)
+    except (OSError, ValueError):
+        pass
+    return database
+
+class StringTable:
+    """
+    Interned strings of a snapshot, decoded on first access
+    """
+
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+        self.cache = [None] * (len(offsets) - 1)
+
+    def __len__(self):
+        return len(self.cache)
+
+    def __getitem__(self, i):
+        value = self.cache[i]
+        if value is None:
+            value = self.cache[i] = str(self.blob[self.offsets[i]:self.offsets[i + 1]], 'utf-8')
+        return value
+
+class ColumnarRelation:
+    """
+    Read-only sequence of records backed by the columns of a snapshot
+    """
+
+    __slots__ = ('strings', 'columns', 'rows')
+
+    def __init__(self, strings, columns, rows):
+        self.strings = strings
+        self.columns = columns
+        self.rows = rows
+
+    def __len__(self):
+        return self.rows
+
+    def __getitem__(self, rid):
+        if isinstance(rid, slice):
+            return [self[i] for i in range(*rid.indices(self.rows))]
+        if rid < 0:
+            rid += self.rows
+        if not 0 <= rid < self.rows:
+            raise IndexError('record index out of range')
+        strings = self.strings
+        return tuple(strings[column[rid]] for column in self.columns)
+
+    def __iter__(self):
+        strings = self.strings
+        for ids in zip(*self.columns):
+            yield tuple(strings[i] for i in ids)
+
+class SnapshotDatabase(Database):
+    """
+    Database reading its relations from a snapshot file through mmap, without copying
+    """
+
+    def __init__(self, filename):
+        super().__init__()
+
+        with open(filename, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = self.view = memoryview(self.mmap)
+
+        magic, version, *_ = HEADER.unpack_from(view, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'Not a database snapshot: {filename}')
+        pos = HEADER.size
+
+        (count,) = struct.unpack_from('<Q', view, pos)
+        pos += 8
+        offsets = view[pos:pos + 8 * (count + 1)].cast('Q')
+        pos += 8 * (count + 1)
+        blob = view[pos:pos + offsets[-1]]
+        pos += offsets[-1]
+        pos += -pos % 8
+        self.strings = StringTable(offsets, blob)
+
+        (count,) = struct.unpack_from('<Q', view, pos)
+        pos += 8
+        for _ in range(count):
+            name_id, arity, rows = struct.unpack_from('<IIQ', view, pos)
+            pos += 16
+            columns = []
+            for _ in range(arity):
+                columns.append(view[pos:pos + 4 * rows].cast('I'))
+                pos += 4 * rows
+            pos += -pos % 8
+            name = self.strings[name_id]
+            self.relations[name] = ColumnarRelation(self.strings, columns, rows)
+
+            (typed,) = struct.unpack_from('<Q', view, pos)
+            pos += 8
+            for _ in range(typed):
+                (column,) = struct.unpack_from('<Q', view, pos)
+                pos += 8
+                self.values[name, column] = view[pos:pos + 8 * rows].cast('q')
+                pos += 8 * rows
+
+    def close(self):
+        self.relations.clear()
+        self.indexes.clear()
+        self.values.clear()
+        self.ranges.clear()
+        self.strings = None
+        self.view.release()
+        self.mmap.close()
+
+    def index(self, name, column):
+        """
+        Hash index of a column, built from the string ids so values are decoded once
+        """
+        key = (name, column)
+        relation = self.relations[name]
+        if key not in self.indexes and isinstance(relation, ColumnarRelation):
+            ids = {}
+            for rid, i in enumerate(relation.columns[column]):
+                ids.setdefault(i, []).append(rid)
+            self.indexes[key] = {self.strings[i]: rids for i, rids in ids.items()}
+        return super().index(name, column)
@@ -0,0 +1,70 @@
+"""
+Times ("7AM 1/7") and durations ("2:00 HR") of the fact database as integers (minutes),
+so they can be compared and sorted.
+"""
+
+import re
+from datetime import date, timedelta
+
+TIME = re.compile(r'(\d{1,2})(?::(\d\d))?(AM|PM) (\d{1,2})/(\d{1,2})$')
+DURATION = re.compile(r'(\d+):(\d\d) HR$')
+
+# the facts have no year: a leap year, so that 29/2 is a valid date
+YEAR = 2000
+
+def parse_time(text):
+    """
+    Minutes since 1/1 0:00, e.g. "7AM 1/7" (7 o'clock in the morning of the 1st of July)
+    """
+    match = TIME.match(text.strip())
+    if not match or not 1 <= int(match.group(1)) <= 12:
+        raise ValueError(f'Invalid time: {text}')
+
+    hour, minute, half, day, month = match.groups()
+    hour = int(hour) % 12 + (12 if half == 'PM' else 0)
+    days = (date(YEAR, int(month), int(day)) - date(YEAR, 1, 1)).days
+
+    return (days * 24 + hour) * 60 + int(minute or 0)
+
+def format_time(minutes):
+    """
+    Inverse of parse_time
+    """
+    days, minutes = divmod(minutes, 24 * 60)
+    hour, minute = divmod(minutes, 60)
+    day = date(YEAR, 1, 1) + timedelta(days=days)
+
+    clock = f'{(hour - 1) % 12 + 1}' + (f':{minute:02}' if minute else '')
+    return f"{clock}{'AM' if hour < 12 else 'PM'} {day.day}/{day.month}"
+
+def parse_duration(text):
+    """
+    Minutes of a duration, e.g. "2:00 HR"
+    """
+    match = DURATION.match(text.strip())
+    if not match:
+        raise ValueError(f'Invalid duration: {text}')
+
+    hours, minutes = match.groups()
+    return int(hours) * 60 + int(minutes)
+
+def format_duration(minutes):
+    return f'{minutes // 60}:{minutes % 60:02} HR'
+
+# integer value of a time or duration that cannot be parsed: never within a Range
+MISSING = -2**63
+
+def parse_or_missing(parse, text):
+    try:
+        return parse(text)
+    except ValueError:
+        return MISSING
+
+# typed columns of the relations, (relation, column) -> parser
+COLUMNS = {
+    ('TIME', 2): parse_time,
+    ('TIME', 4): parse_time,
+    ('DTIME', 2): parse_time,
+    ('ATIME', 2): parse_time,
+    ('RUN-TIME', 3): parse_duration,
+}
@@ -1,30 +1,45 @@
+from collections import OrderedDict
+
 class Tokenizer:
 
     # use an additional token map for multi-word tokens (e.g. New York)
     def __init__(self, token_map):
         self.token_map = token_map
 
+        # word-level trie of the token map, for longest-match segmentation
+        # e.g. {"New": {"York": {None: "New_York"}}}, None marks the end of a phrase
+        self.trie = {}
+        for phrase, token in token_map.items():
+            node = self.trie
+            for word in phrase.split(' '):
+                node = node.setdefault(word, {})
+            node[None] = token
+
     def tokenize(self, text):
 
         tokens = []
-        if text[-1] in ['.', '?', '!']:
+        if text and text[-1] in ['.', '?', '!']:
             text = text[:-1] + ' ' + text[-1]
         words = text.split()
 
-        phrase_maxlen = max(map(len, self.token_map.keys()))
-
         i = 0
         while i < len(words):
-            # check for multi-word tokens
-            for j in range(i + phrase_maxlen, i, -1):
-                phrase = ' '.join(words[i:j])
-                if phrase in self.token_map.keys():
-                    tokens.append(self.token_map[phrase])
-                    i = j - 1
-                    break
+            # find the longest multi-word token starting at i
+            node = self.trie
+            match = None
+            j = i
+            while j < len(words) and words[j] in node:
+                node = node[words[j]]
+                j += 1
+                if None in node:
+                    match = node[None], j
+
+            if match:
+                tokens.append(match[0])
+                i = match[1]
             else:
                 tokens.append(words[i])
-            i += 1
+                i += 1
 
         return tokens
     
@@ -69,21 +84,154 @@ class VariableManager:
 
     def __init__(self):
         self.variables = {}
+        self.keys = {} # (prefix, value) -> key
+        self.counters = {} # prefix -> number of its keys
 
     def set(self, name, value):
 
         # name: tour, time -> key: t1, t2, ...
+        # the same value (of the same prefix) always gets the same key
         
-        key = name.lower()[0] + '1'
+        prefix = name.lower()[0]
+        key = self.keys.get((prefix, value))
 
-        while key in self.variables:
-            if self.variables[key] == value:
-                break
-            key = key[:-1] + str(int(key[-1]) + 1)
+        if key is None:
+            count = self.counters[prefix] = self.counters.get(prefix, 0) + 1
+            key = self.keys[prefix, value] = f'{prefix}{count}'
 
         self.variables[key] = value
         
         return key
 
     def get(self, name):
-        return self.variables.get(name, None)
\ No newline at end of file
+        return self.variables.get(name, None)
+
+class Vocabulary:
+    """
+    Interned symbols (e.g. POS tags) coded as small integers, in order of addition.
+    Codes are looked up like an enum: vocab['N-LOC'], or vocab.ROOT for identifiers.
+    """
+
+    def __init__(self, names=()):
+        self.names = []
+        self.codes = {}
+        for name in names:
+            self.code(name)
+
+    def code(self, name):
+        """
+        Code of a symbol, added to the vocabulary if it is new
+        """
+        code = self.codes.get(name)
+        if code is None:
+            code = self.codes[name] = len(self.names)
+            self.names.append(name)
+        return code
+
+    def name(self, code):
+        return self.names[code]
+
+    def __getitem__(self, name):
+        return self.codes[name]
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['codes'][name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def __contains__(self, name):
+        return name in self.codes
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return iter(self.names)
+
+class OutputWriter:
+    """
+    Buffered writer for the output files: the file is opened once per run,
+    and the written text is kept in memory and flushed in bulk.
+    If no filename is given, the text is only kept in memory (see getvalue).
+    """
+
+    def __init__(self, filename=None, mode='w', buffer_size=1 << 16):
+        self.filename = filename
+        self.buffer_size = buffer_size
+        self.chunks = []
+        self.size = 0
+        self.file = open(filename, mode, encoding='utf-8') if filename else None
+
+    def write(self, text):
+        self.chunks.append(text)
+        self.size += len(text)
+        if self.file and self.size >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.file:
+            self.file.write(''.join(self.chunks))
+            self.file.flush()
+            self.chunks = []
+            self.size = 0
+
+    def getvalue(self):
+        return ''.join(self.chunks)
+
+    def close(self):
+        if self.file:
+            self.flush()
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class LRUCache:
+    """
+    Bounded mapping evicting the least recently used entries, with hit/miss counters
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key, default=None):
+        try:
+            value = self.data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self.data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def clear(self):
+        self.data.clear()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self.data),
+            'maxsize': self.maxsize,
+        }
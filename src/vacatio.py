@@ -1,8 +1,11 @@
+from functools import lru_cache
+from itertools import product
 from typing import List
+from src import instrument
 from src.cfg import ContextFreeGrammar
-from src.dep import Dependency, DependencyGrammar, TransitionClassifier
+from src.dep import Dependency, DependencyGrammar, DependencyGraph, TransitionClassifier
 from src.logic import Entity, LogicalForm, ThematicRole
-from src.procedure import FilterProcedure, Procedure, SelectProcedure
+from src.procedure import FilterProcedure, Procedure, ProcedureCache, SelectProcedure
 from src.relation import Relation
 from src.util import POSTagger, Tokenizer, VariableManager
 
@@ -19,38 +22,67 @@ QUANTIFIERS = ["một ít", "nhiều", "vài", "một số", "tất cả", "nh
 PRONOUNS = ["tôi", "bạn", "anh", "chị", "em", "họ", "ai"]
 DEMONSTRATIVES = ["này", "đó", "kia", "ấy", "đây"]
 
-def context_free_grammar() -> ContextFreeGrammar:
-
-    return ContextFreeGrammar.fromstring(
-"""
-S -> SUBJ PRED | PRED
-SUBJ -> NP
-PRED -> VP | ADJP
-NP -> PRO | NPI | NPI DEMON | NPI PP
-NPI -> N | NUM N | QUANT N | N ADJ
-VP -> VPI | VPI ADV_VTAIL 
-VPI -> V | V NP | ADV_VHEAD V | ADV_VHEAD V NP
-ADJP -> ADJ | ADV_AHEAD ADJ | ADJ ADV_ATAIL
-PP -> P NP
-""" +
-        "\n".join([
-            f"{lhs} -> {' | '.join([ ' '.join(rhs) for rhs in rhslist ])}"
-            for lhs, rhslist in {
-                "PRO": [[pro] for pro in PRONOUNS],
-                "N": [[noun] for noun in NOUNS],
-                "V": [[verb] for verb in VERBS],
-                "ADJ": [[adj] for adj in ADJECTIVES],
-                "ADV_AHEAD": [[adv] for adv in ADVERBS_AHEAD],
-                "ADV_ATAIL": [[adv] for adv in ADVERBS_ATAIL],
-                "ADV_VHEAD": [[adv] for adv in ADVERBS_VHEAD],
-                "ADV_VTAIL": [[adv] for adv in ADVERBS_VTAIL],
-                "NUM": [[num] for num in NUMERALS],
-                "QUANT": [[quant] for quant in QUANTIFIERS],
-                "P": [[prep] for prep in PREPOSITIONS],
-                "DEMON": [[dem] for dem in DEMONSTRATIVES]
-            }.items()
-        ])
-    )
+# phrase structure rules of the context-free grammar, the lexical rules come from LEXICON
+PHRASE_RULES = {
+    "S": [["SUBJ", "PRED"], ["PRED"]],
+    "SUBJ": [["NP"]],
+    "PRED": [["VP"], ["ADJP"]],
+    "NP": [["PRO"], ["NPI"], ["NPI", "DEMON"], ["NPI", "PP"]],
+    "NPI": [["N"], ["NUM", "N"], ["QUANT", "N"], ["N", "ADJ"]],
+    "VP": [["VPI"], ["VPI", "ADV_VTAIL"]],
+    "VPI": [["V"], ["V", "NP"], ["ADV_VHEAD", "V"], ["ADV_VHEAD", "V", "NP"]],
+    "ADJP": [["ADJ"], ["ADV_AHEAD", "ADJ"], ["ADJ", "ADV_ATAIL"]],
+    "PP": [["P", "NP"]],
+}
+
+LEXICON = {
+    "PRO": PRONOUNS,
+    "N": NOUNS,
+    "V": VERBS,
+    "ADJ": ADJECTIVES,
+    "ADV_AHEAD": ADVERBS_AHEAD,
+    "ADV_ATAIL": ADVERBS_ATAIL,
+    "ADV_VHEAD": ADVERBS_VHEAD,
+    "ADV_VTAIL": ADVERBS_VTAIL,
+    "NUM": NUMERALS,
+    "QUANT": QUANTIFIERS,
+    "P": PREPOSITIONS,
+    "DEMON": DEMONSTRATIVES,
+}
+
+def load_lexicon(filename):
+    """
+    Read a lexicon file, one tag per line: TAG -> word | multi word | ...
+    (blank lines and lines starting with # are ignored), returns {tag: [words]}
+    """
+    lexicon = {}
+    with open(filename, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            tag, words = line.split(' -> ')
+            lexicon.setdefault(tag.strip(), []).extend(
+                word.strip() for word in words.split(' | ') if word.strip()
+            )
+    return lexicon
+
+@lru_cache(maxsize=None)
+def context_free_grammar(lexicon=None) -> ContextFreeGrammar:
+    """
+    The grammar of PHRASE_RULES and LEXICON, built once per process. The words of
+    a lexicon file replace those of LEXICON for the tags it lists.
+    """
+    words = dict(LEXICON)
+    if lexicon is not None:
+        words.update(load_lexicon(lexicon))
+
+    rules = {lhs: [list(rhs) for rhs in rhslist] for lhs, rhslist in PHRASE_RULES.items()}
+    for tag, entries in words.items():
+        # multi-word entries are sequences of terminals
+        rules[tag] = [word.split() for word in entries]
+
+    return ContextFreeGrammar("S", rules)
 
 # Token map for multi-word tokens
 TOKEN_MAP = {
@@ -60,6 +92,8 @@ TOKEN_MAP = {
     "bao lâu": "bao_lâu",
     "bao nhiêu": "bao_nhiêu",
     "phương tiện": "phương_tiện",
+    "máy bay": "máy_bay",
+    "tàu hỏa": "tàu_hỏa",
     "Hồ Chí Minh": "Hồ_Chí_Minh",
     "Nha Trang": "Nha_Trang",
     "Phú Quốc": "Phú_Quốc",
@@ -84,6 +118,8 @@ POS_DICT = {
     "có": "V",
     "bao_nhiêu": "DET-Q",
     "phương_tiện": "N",
+    "máy_bay": "N",
+    "tàu_hỏa": "N",
     "vậy": "DISC",
     "bạn": "PRO",
     "bằng": "P",
@@ -134,7 +170,6 @@ def get_transition(features):
         - s = V and b = DISC/PUNCT and has_main_verb
     """
 
-    deps = features['deps']
     sword = features['sword']
     bword = features['bword']
     spos = features['spos']
@@ -142,6 +177,7 @@ def get_transition(features):
     sindex = features['sindex']
     bindex = features['bindex']
     has_main_verb = features['has_main_verb']
+    has_case = features['has_case']
 
     if spos == 'ADV' and bpos in ['DET']:
         return 'REDUCE'
@@ -177,10 +213,7 @@ def get_transition(features):
         return 'RIGHT_ARC advmod'
     if spos == 'V' and bpos in ['PRO', 'N', 'N-Q', 'N-LOC']:
 
-        if any([
-            dep.head.index == sindex and dep.label == 'case'
-            for dep in deps
-        ]):
+        if has_case:
             return 'RIGHT_ARC obl'
         
         return 'RIGHT_ARC obj'
@@ -198,33 +231,95 @@ def get_transition(features):
     
     raise Exception(f'Cannot determine transition for {spos} - {bpos}')
 
-def dependency_grammar() -> DependencyGrammar:
+def transition_key(features):
+    """
+    Lookup key of the features get_transition looks at
+    """
+    return (
+        features['spos'],
+        features['bpos'],
+        features['has_main_verb'],
+        features['has_case'],
+        features['sword'] == 'tour' and features['bword'] == 'đi',
+    )
+
+def transition_feature_space():
+    """
+    Features covering every key of transition_key, to compile get_transition
+    """
+    tags = [None, 'ROOT', 'UNK'] + sorted(set(POS_DICT.values()))
+
+    for spos, bpos, has_main_verb, has_case, tour in product(
+        tags, tags, [False, True], [False, True], [False, True]
+    ):
+        yield {
+            'sword': 'tour' if tour else None,
+            'bword': 'đi' if tour else None,
+            'spos': spos,
+            'bpos': bpos,
+            'sindex': 0,
+            'bindex': 1,
+            'has_main_verb': has_main_verb,
+            'has_case': has_case,
+        }
+
+@lru_cache(maxsize=None)
+def _components(lexicon=None):
+    """
+    Tokenizer, tagger and compiled classifier, shared by the grammars of a process
+    """
+    token_map = dict(TOKEN_MAP)
+    pos_dict = dict(POS_DICT)
+    if lexicon is not None:
+        for tag, words in load_lexicon(lexicon).items():
+            for word in words:
+                token = word.replace(' ', '_')
+                if token != word:
+                    token_map[word] = token
+                pos_dict[token] = tag
+
+    classifier = TransitionClassifier(get_transition, key=transition_key)
+    classifier.compile(transition_feature_space())
+
+    return Tokenizer(token_map=token_map), POSTagger(pos_dict=pos_dict), classifier
+
+def dependency_grammar(lexicon=None) -> DependencyGrammar:
+    """
+    A new grammar (it keeps the state of its last parse), its components are built
+    once per process. The words of a lexicon file are added to TOKEN_MAP and POS_DICT.
+    """
+    tokenizer, pos_tagger, classifier = _components(lexicon)
 
     return DependencyGrammar(
-        tokenizer=Tokenizer(token_map=TOKEN_MAP),
-        pos_tagger=POSTagger(pos_dict=POS_DICT),
-        transition_classifier=TransitionClassifier(get_transition)
+        tokenizer=tokenizer,
+        pos_tagger=pos_tagger,
+        transition_classifier=classifier
     )
 
 # life is full of heuristics
 # this is one of them
+@instrument.profiled('relationalize')
 def relationalize(dependencies: List[Dependency]):
 
     # extract useful relations based on database in input/database.txt
+    # (in the order of the dependencies, which sets the numbering of the variables)
+    graph = dependencies if isinstance(dependencies, DependencyGraph) else DependencyGraph(dependencies)
     relations = []
     from_loc = None
     to_loc = None
-    tour_name = None
+    instr = None
     varm = VariableManager()
 
-    for dep in dependencies:
+    for dep in graph:
+
+        label = dep.label
 
         # for main predicates
-        if dep.label == 'root':
+        if label == 'root':
             relations.append(Relation('VERB', dep.tail.word))
 
         # for quantifiers
-        if dep.label == 'det':
+        elif label == 'det':
             if dep.tail.word == 'bao_nhiêu':
                 relations.append(Relation('HOW-MANY', dep.head.word))
             if dep.tail.word == 'tất_cả':
@@ -237,22 +332,28 @@ def relationalize(dependencies: List[Dependency]):
             relations.append(Relation('COMMAND', dep.head.word))
 
         # for locations
-        if dep.label == 'case':
+        if label == 'case':
             if dep.tail.word == 'từ':
                 from_loc = dep.head.word
             if dep.tail.word == 'đến':
                 to_loc = dep.head.word
+            if dep.tail.word == 'bằng':
+                # the vehicle, unless it is asked for (phương tiện gì)
+                if not any(comp.tail.word in ['gì', 'nào'] for comp in graph.dependents(dep.head, 'compound')):
+                    instr = dep.head.word
 
         # for themes
-        if dep.label == 'obj':
+        elif label == 'obj':
 
             if dep.head.word == 'đi':
                 if dep.tail.pos == 'N-LOC':
                     if dep.tail.word not in [from_loc, to_loc]:
                         to_loc = dep.tail.word
                 elif dep.tail.word == 'tour':
-                    if tour_name:
-                        to_loc = tour_name
+                    # name of the tour: its compound location
+                    for comp in graph.dependents(dep.tail, 'compound'):
+                        if comp.tail.pos == 'N-LOC':
+                            to_loc = comp.tail.word
                     relations.append(Relation('THEME', dep.tail.word))
 
             elif dep.tail.word == 'bao_lâu':
@@ -261,21 +362,21 @@ def relationalize(dependencies: List[Dependency]):
                 relations.append(Relation('THEME', dep.tail.word))
 
         # for compound nouns
-        if dep.label == 'compound' and dep.head.pos in ['N', 'N-LOC']:
+        elif label == 'compound' and dep.head.pos in ['N', 'N-LOC']:
 
             if dep.tail.word in ['gì', 'nào']:
                 relations.append(Relation('WH', dep.head.word))
             else:
                 relations.append(Relation('THE', dep.head.word))
-                if dep.head.word == 'tour':
-                    tour_name = dep.tail.word
-                else:
+                if dep.head.word != 'tour':
                     relations.append(Relation('COMP', dep.head.word, dep.tail.word))        
 
     if from_loc:
         relations.append(Relation('FROM-LOC', from_loc))
     if to_loc:
         relations.append(Relation('TO-LOC', to_loc))
+    if instr:
+        relations.append(Relation('INSTR', instr))
 
     for rel in relations:
         entity = rel.args[0]
@@ -284,6 +385,7 @@ def relationalize(dependencies: List[Dependency]):
 
     return relations
 
+@instrument.profiled('logicalize')
 def logicalize(relations: List[Relation]) -> LogicalForm:
     
     # speech act
@@ -331,6 +433,12 @@ def logicalize(relations: List[Relation]) -> LogicalForm:
                 Entity('NAME', rel.var, rel.args[0]), 
                 rel.var
             ))
+        if rel.pred == 'INSTR':
+            thematic_roles.append(ThematicRole(
+                'INSTR',
+                Entity('NAME', rel.var, rel.args[0]),
+                rel.var
+            ))
 
     for tr in thematic_roles:
         for e in entities:
@@ -344,6 +452,7 @@ def logicalize(relations: List[Relation]) -> LogicalForm:
     lf_spact.add_argument(lf_verb)
     return lf_spact
 
+@instrument.profiled('proceduralize')
 def proceduralize(logical_form: LogicalForm) -> Procedure:
     
     DATA = {
@@ -353,8 +462,8 @@ def proceduralize(logical_form: LogicalForm) -> Procedure:
     }
 
     VEHICLE = {
-        'máy bay': 'airplane',
-        'tàu hỏa': 'train',
+        'máy_bay': 'airplane',
+        'tàu_hỏa': 'train',
     }
 
     LOCATION = {
@@ -430,7 +539,7 @@ def proceduralize(logical_form: LogicalForm) -> Procedure:
             elif tr.role == 'TIME':
                 atime = tr.entity.name
 
-            # TODO: FROM-TIME, TO-TIME
+            # TODO: FROM-TIME, TO-TIME (the procedures take Range criteria)
 
         proc.criteria = [tour, dloc, dtime, aloc, atime]
 
@@ -462,9 +571,16 @@ def proceduralize(logical_form: LogicalForm) -> Procedure:
 
         proc.criteria = [tour, vehicle]
 
+    # constraints on the other relations are joined on the tour
+    if proc.data != 'BY':
+        for tr in thematic_roles:
+            if tr.role == 'INSTR' and tr.entity.name in VEHICLE:
+                proc.join(FilterProcedure('BY', [None, VEHICLE[tr.entity.name]]))
+
     return proc
 
-def answer(proc: Procedure, db: dict):
+@instrument.profiled('answer')
+def answer(proc: Procedure, db: dict, cache: ProcedureCache = None):
 
     LANG = {
         'PQ': 'Phú Quốc',
@@ -488,7 +604,7 @@ def answer(proc: Procedure, db: dict):
         
         return f"{hour} giờ {minute} phút"
     
-    res = proc.execute(db)
+    res = cache.execute(proc, db) if cache else proc.execute(db)
 
     if proc.action == 'SELECT':
 
@@ -0,0 +1,81 @@
+import itertools
+import random
+import pytest
+from src import vacatio
+from src.cfg import ContextFreeGrammar
+
+def sentence(grammar, rules):
+    """
+    Words derived by the rules of a parse tree (leftmost derivation)
+    """
+    rules = iter(rules)
+    def expand(sym):
+        if grammar.is_terminal(sym):
+            return [sym]
+        lhs, rhs = next(rules)
+        assert lhs == sym
+        return [word for child in rhs for word in expand(child)]
+    words = expand(grammar.start)
+    assert next(rules, None) is None
+    return words
+
+def derivable(grammar, words):
+    """
+    Whether the grammar derives the words, by a fixpoint over the spans of the symbols
+    """
+    n = len(words)
+    spans = set() # (sym, i, j)
+
+    def ends(rhs, i):
+        # end positions of the sequence rhs derived from position i
+        positions = {i}
+        for sym in rhs:
+            positions = {
+                j for k in positions for j in range(k, n + 1)
+                if (sym, k, j) in spans
+                or (grammar.is_terminal(sym) and j == k + 1 and words[k] == sym)
+            }
+        return positions
+
+    changed = True
+    while changed:
+        changed = False
+        for lhs, rhslist in grammar.rules.items():
+            for i in range(n + 1):
+                for rhs in rhslist:
+                    for j in ends(rhs, i):
+                        if (lhs, i, j) not in spans:
+                            spans.add((lhs, i, j))
+                            changed = True
+    return (grammar.start, 0, n) in spans
+
+@pytest.mark.parametrize('rules', [
+    {'S': [['S', 'S'], ['a'], []]},
+    {'S': [['A', 'S', 'b'], ['A'], []], 'A': [['S'], ['a'], []]},
+    {'S': [['A', 'B']], 'A': [['B'], ['a'], []], 'B': [['A'], ['b'], []]},
+])
+def test_earley_nullable_cyclic_rules(rules):
+    grammar = ContextFreeGrammar('S', rules)
+    for length in range(6):
+        for words in itertools.product('ab', repeat=length):
+            words = list(words)
+            tree = grammar._parse_earley(words)
+            assert (tree is not None) == derivable(grammar, words), words
+            if tree is not None:
+                assert sentence(grammar, tree) == words
+
+def test_earley_same_tree_as_topdown():
+    grammar = vacatio.context_free_grammar()
+    for sent in grammar.iter_sample(10, seed=0, max_samples=300):
+        words = sent.split()
+        assert grammar._parse_earley(words) == grammar._parse_topdown(words)
+
+def test_generate_follows_random_seed():
+    grammar = vacatio.context_free_grammar()
+    samples = []
+    for _ in range(2):
+        random.seed(42)
+        samples.append(list(grammar.iter_generate(10, max_samples=20)))
+    assert samples[0] == samples[1]
+    assert list(grammar.iter_generate(10, seed=1, max_samples=20)) == \
+        list(grammar.iter_generate(10, seed=1, max_samples=20))
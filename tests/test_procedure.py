@@ -0,0 +1,76 @@
+import os
+import pytest
+from src import loader, snapshot
+from src.database import Range
+from src.procedure import FilterProcedure, SelectProcedure
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@pytest.fixture(scope='module')
+def backends(tmp_path_factory):
+    source = os.path.join(ROOT, 'input', 'database.txt')
+    database = loader.load(source)
+    filename = str(tmp_path_factory.mktemp('snapshot') / 'database.snap')
+    snapshot.save(database, filename, source)
+
+    backends = {
+        'dict': {name: list(database[name]) for name in database.keys()},
+        'database': database,
+        'snapshot': snapshot.SnapshotDatabase(filename),
+    }
+    try:
+        from src.columnar import ColumnarDatabase
+        backends['columnar'] = ColumnarDatabase.of(database)
+    except ImportError:
+        pass
+    yield backends
+    backends['snapshot'].close()
+
+PROCEDURES = [
+    lambda: FilterProcedure('TIME', [None, None, None, None, None]),
+    lambda: SelectProcedure(2, 'BY', ['NT', None]),
+    lambda: FilterProcedure('TIME', [None, 'HCMC', Range('7AM 1/7', '7AM 4/7'), None, None]),
+    lambda: SelectProcedure(4, 'RUN-TIME', [None, None, None, Range(None, '2:00 HR')]),
+    # joins, probed with a range on the key column
+    lambda: FilterProcedure('BY', [Range('DN', 'PQ'), None]).join(FilterProcedure('BY', [None, 'train'])),
+    lambda: FilterProcedure('BY', [None, None])
+        .join(FilterProcedure('BY', [None, None]))
+        .join(FilterProcedure('BY', [Range('PQ', 'PQ'), None])),
+    lambda: FilterProcedure('TIME', [Range('DN', 'NT'), None, None, None, None])
+        .join(FilterProcedure('BY', [None, 'airplane'])),
+]
+
+@pytest.mark.parametrize('make', PROCEDURES)
+def test_backends_agree(backends, make):
+    expected = make().execute(backends['dict'])
+    assert expected
+    for name, database in backends.items():
+        assert make().execute(database) == expected, name
+
+def test_malformed_times_are_loaded(tmp_path):
+    source = tmp_path / 'database.txt'
+    with open(os.path.join(ROOT, 'input', 'database.txt'), encoding='utf-8') as f:
+        text = f.read()
+    source.write_text(text + '\n(DTIME XX HCMC "7 AM 1/7") (ATIME XX XX "9AM 1/7")\n', encoding='utf-8')
+    database = loader.load(str(source))
+    filename = str(tmp_path / 'database.snap')
+    snapshot.save(database, filename, str(source))
+
+    backends = {
+        'dict': {name: list(database[name]) for name in database.keys()},
+        'database': database,
+        'snapshot': snapshot.SnapshotDatabase(filename),
+    }
+    try:
+        from src.columnar import ColumnarDatabase
+        backends['columnar'] = ColumnarDatabase.of(database)
+    except ImportError:
+        pass
+
+    for name, backend in backends.items():
+        # kept as text, but never within a range
+        assert FilterProcedure('TIME', ['XX', None, None, None, None]).execute(backend), name
+        for window in [Range(None, None), Range(None, '12PM 31/12'), Range('1AM 1/1', None)]:
+            records = FilterProcedure('TIME', [None, None, window, None, None]).execute(backend)
+            assert records and all(rec[0] != 'XX' for rec in records), name
+    backends['snapshot'].close()
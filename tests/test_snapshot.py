@@ -0,0 +1,58 @@
+import os
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from src import loader, snapshot
+from src.database import Database
+
+FACTS = '(TOUR PQ Phú_Quốc) (BY PQ airplane)\n'
+
+def write(tmp_path, text):
+    path = tmp_path / 'database.txt'
+    path.write_text(text, encoding='utf-8')
+    return str(path)
+
+def test_load_cached_opens_the_snapshot(tmp_path):
+    source = write(tmp_path, FACTS)
+    snapshot.load_cached(source)
+    database = snapshot.load_cached(source)
+    assert isinstance(database, snapshot.SnapshotDatabase)
+    assert list(database['BY']) == [('PQ', 'airplane')]
+    database.close()
+
+def test_save_rejects_records_of_different_arities(tmp_path):
+    database = Database({'FOO': [('a', 'b'), ('c',)]})
+    with pytest.raises(ValueError):
+        snapshot.save(database, str(tmp_path / 'database.snap'))
+    assert os.listdir(tmp_path) == []
+
+def test_load_cached_falls_back_to_the_source(tmp_path):
+    source = write(tmp_path, FACTS + '(FOO a b) (FOO c)\n')
+    database = snapshot.load_cached(source)
+    assert not isinstance(database, snapshot.SnapshotDatabase)
+    assert database['FOO'] == [('a', 'b'), ('c',)]
+    assert not os.path.exists(source + '.snap')
+
+def test_touched_source_is_hashed_once(tmp_path, monkeypatch):
+    source = write(tmp_path, FACTS)
+    filename = source + '.snap'
+    snapshot.load_cached(source)
+    stat = os.stat(source)
+    os.utime(source, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert snapshot.is_fresh(filename, source)
+
+    def digest(filename):
+        raise AssertionError('source hashed again')
+    monkeypatch.setattr(snapshot, '_digest', digest)
+    assert snapshot.is_fresh(filename, source)
+
+def test_concurrent_writers(tmp_path):
+    source = write(tmp_path, FACTS * 200)
+    filename = source + '.snap'
+    database = loader.load(source)
+    with ThreadPoolExecutor(8) as pool:
+        list(pool.map(lambda _: snapshot.save(database, filename, source), range(32)))
+
+    assert sorted(os.listdir(tmp_path)) == ['database.txt', 'database.txt.snap']
+    opened = snapshot.SnapshotDatabase(filename)
+    assert list(opened['BY']) == list(database['BY'])
+    opened.close()
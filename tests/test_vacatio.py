@@ -0,0 +1,47 @@
+import contextlib
+import io
+import os
+import pytest
+from src import loader, vacatio
+from src.pipeline import Pipeline
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@pytest.fixture(scope='module')
+def pipeline():
+    return Pipeline(database=loader.load(os.path.join(ROOT, 'input', 'database.txt')))
+
+def run(pipeline, question):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return pipeline.run(question)
+
+@pytest.mark.parametrize('question', [
+    'tour Nha Trang đi bằng phương tiện gì vậy?',
+    'đi tour Nha Trang bằng phương tiện gì vậy?',
+    'tour tour Nha Trang đi bằng phương tiện gì vậy?',
+])
+def test_tour_name_is_its_location(pipeline, question):
+    result = run(pipeline, question)
+    assert repr(result.procedure) == 'SELECT ?x (BY NT ?x)'
+    assert result.answer == 'Tour Nha Trang đi bằng tàu hỏa.'
+
+@pytest.mark.parametrize('question, procedure, tours', [
+    ('có bao nhiêu tour đi bằng máy bay vậy bạn?',
+     'FILTER (DTIME * * *) (ATIME * * *) JOIN (BY * airplane)', 4),
+    ('có bao nhiêu tour đi Phú Quốc bằng máy bay vậy bạn?',
+     'FILTER (DTIME PQ * *) (ATIME PQ PQ *) JOIN (BY * airplane)', 2),
+    ('có bao nhiêu tour đi Phú Quốc bằng tàu hỏa vậy bạn?',
+     'FILTER (DTIME PQ * *) (ATIME PQ PQ *) JOIN (BY * train)', 0),
+])
+def test_vehicle_is_joined(pipeline, question, procedure, tours):
+    result = run(pipeline, question)
+    assert repr(result.procedure) == procedure
+    if tours:
+        assert result.answer.startswith(f'Có {tours} tour:')
+    else:
+        assert result.answer == 'Không tìm thấy tour phù hợp.'
+
+def test_compiled_transitions_match_the_rules():
+    _, _, classifier = vacatio._components()
+    assert classifier.table
+    assert classifier.verify(vacatio.transition_feature_space()) == []